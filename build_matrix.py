@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Builds several configurations of the protobuf recipe from one source checkout.
+
+`conan create` per build_type clones, patches and configures the sources again
+for every configuration. This script runs `conan source` (clone + _patch_sources)
+once and then builds every configuration from that tree with the local flow:
+
+    conan install -> conan build -> conan export-pkg
+
+`conan build` runs in parallel for up to --parallel configurations. Each of them
+gets an equal share of the --jobs compile jobs through CONAN_CPU_COUNT and, with
+build_jobs=auto, of the available memory through CONAN_PROTOBUF_PARALLEL_BUILDS. `conan
+export-pkg` computes the package ID from the settings and options of each
+configuration and runs package(), including the Debug library copies on Linux.
+
+Example:
+    python build_matrix.py conan/stable --profile gcc \\
+        --build-types Debug,Release,RelWithDebInfo --shared False,True
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+RECIPE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def _run(command, env=None, lock=None):
+    print("build_matrix: {}".format(" ".join(command)), flush=True)
+    if lock is None:
+        subprocess.check_call(command, cwd=RECIPE_FOLDER, env=env)
+    else:
+        with lock:
+            subprocess.check_call(command, cwd=RECIPE_FOLDER, env=env)
+
+
+def _build_configuration(args, source_folder, build_type, shared, cpu_count, parallel, cache_lock):
+    name = "{}-{}".format(build_type, "shared" if shared == "True" else "static")
+    build_folder = os.path.join(args.work_folder, name)
+    profile_args = ["--profile", args.profile] if args.profile else []
+    config_args = ["-s", "build_type={}".format(build_type), "-o", "protobuf:shared={}".format(shared)]
+    for setting in args.setting:
+        config_args.extend(["-s", setting])
+    for option in args.option:
+        config_args.extend(["-o", option])
+
+    env = dict(os.environ, CONAN_CPU_COUNT=str(cpu_count), CONAN_PROTOBUF_PARALLEL_BUILDS=str(parallel))
+    # install and export-pkg write to the shared Conan cache, keep them sequential
+    _run(["conan", "install", ".", "--install-folder", build_folder, "--build", "missing"] + profile_args + config_args,
+         env=env, lock=cache_lock)
+    _run(["conan", "build", ".", "--source-folder", source_folder, "--build-folder", build_folder,
+          "--install-folder", build_folder], env=env)
+    _run(["conan", "export-pkg", ".", args.reference, "--source-folder", source_folder, "--build-folder", build_folder,
+          "--force"] + profile_args + config_args, env=env, lock=cache_lock)
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("reference", help="user/channel of the packages, e.g. conan/stable")
+    parser.add_argument("--profile", help="Conan profile used for every configuration")
+    parser.add_argument("--build-types", default="Debug,Release", help="comma separated build_type values")
+    parser.add_argument("--shared", default="False", help="comma separated protobuf:shared values")
+    parser.add_argument("-s", "--setting", action="append", default=[], help="extra setting for every configuration")
+    parser.add_argument("-o", "--option", action="append", default=[], help="extra option for every configuration")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="total compile jobs shared by the configurations built in parallel")
+    parser.add_argument("--parallel", type=int, default=2, help="configurations built at the same time")
+    parser.add_argument("--work-folder", default=os.path.join(RECIPE_FOLDER, "build_matrix"),
+                        help="folder for the shared sources and the per-configuration build folders")
+    args = parser.parse_args()
+    args.work_folder = os.path.abspath(args.work_folder)
+
+    configurations = list(itertools.product(args.build_types.split(","), args.shared.split(",")))
+    parallel = max(1, min(args.parallel, len(configurations), args.jobs))
+    cpu_count = max(1, args.jobs // parallel)
+
+    source_folder = os.path.join(args.work_folder, "source")
+    if not os.path.isdir(os.path.join(source_folder, "source_subfolder")):
+        _run(["conan", "source", ".", "--source-folder", source_folder])
+
+    cache_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(_build_configuration, args, source_folder, build_type, shared, cpu_count, parallel,
+                                   cache_lock)
+                   for build_type, shared in configurations]
+        failed = False
+        for future in futures:
+            try:
+                print("build_matrix: {} packaged".format(future.result()), flush=True)
+            except subprocess.CalledProcessError as error:
+                print("build_matrix: {}".format(error), file=sys.stderr, flush=True)
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
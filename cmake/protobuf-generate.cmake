@@ -0,0 +1,633 @@
+# protobuf_generate() for consumers of the Conan package.
+#
+# The Conan generators don't load protobuf-config.cmake, where upstream defines
+# protobuf_generate(), so the recipe ships this module in cmake_build_modules.
+# It takes the arguments of the protobuf 3.9 function plus PLUGIN and
+# PLUGIN_OPTIONS (from later releases), BATCH_SIZE and CODEGEN_PROFILE:
+#
+#   protobuf_generate(
+#     [TARGET <target>] [OUT_VAR <var>] [PROTOS <file>...]
+#     [LANGUAGE <cpp|python|...>] [GENERATE_EXTENSIONS <ext>...]
+#     [EXPORT_MACRO <macro>] [PROTOC_OUT_DIR <dir>]
+#     [IMPORT_DIRS <dir>...] [APPEND_PATH]
+#     [PLUGIN <protoc-gen-NAME=path>] [PLUGIN_OPTIONS <options>]
+#     [BATCH_SIZE <n>] [CODEGEN_PROFILE <none|speed|size|lite>])
+#
+# protoc is Protobuf_PROTOC_EXECUTABLE when set, else the protoc of this package.
+# Every output depends on its .proto file and on the files it imports,
+# transitively, as found at configure time.
+#
+# Batching: by default protoc runs once per .proto file. With BATCH_SIZE (or
+# the PROTOBUF_GENERATE_BATCH_SIZE variable) the files are grouped by the import
+# dir that contains them and each group is split in batches of up to <n> files,
+# one protoc run per batch, so shared imports are parsed once per batch instead
+# of once per file. Batches are independent custom commands, the build tool runs
+# them in parallel. protoc writes a batch to a staging folder and only the
+# outputs whose content changed are copied out, so with Ninja (restat) editing
+# one .proto file doesn't recompile the other files of its batch; Makefile
+# generators touch every output of a custom command and recompile them all.
+#
+# Codegen profile: the optimize_for of the generated C++ code, for every .proto
+# file regardless of its own option: speed (SPEED), size (CODE_SIZE, reflection
+# based parsing and serialization) or lite (LITE_RUNTIME, no descriptors nor
+# reflection). Defaults to the PROTOBUF_GENERATE_CODEGEN_PROFILE variable, then to
+# the codegen_profile option of the package (protobuf_CODEGEN_PROFILE, from
+# protobuf-options.cmake); none keeps the optimize_for of each file. The runtime
+# the generated code needs must be one the package ships (protobuf_CONAN_RUNTIMES),
+# lite code that imports google/protobuf/*.proto needs libprotobuf as well, whose
+# well-known types the lite runtime doesn't have. A mismatch is a configure error.
+#
+# Content-hash cache: when PROTOBUF_GENERATE_CACHE_DIR is set (CMake or
+# environment variable), protoc runs through this file in script mode. It
+# hashes the protoc and plugin binaries, the plugin options, the .proto file
+# and its transitive imports; on a hit the generated files are copied from the
+# cache, on a miss protoc runs and its outputs are stored. Switching branches
+# then only runs protoc for the .proto files whose content really changed.
+# Batches only pass their cache misses to protoc.
+# Entries are never evicted, remove old ones with e.g.
+#   find "$PROTOBUF_GENERATE_CACHE_DIR" -type f -atime +30 -delete
+
+# Bump when the cache key or layout changes
+set(_PROTOBUF_GENERATE_CACHE_FORMAT 1)
+
+# Maps `file` to its name relative to the first of `import_dirs` that contains it, as protoc
+# does with its --proto_path arguments, and returns that import dir in `out_dir`.
+# Both are empty if no import dir contains the file.
+function(_protobuf_generate_virtual_path file import_dirs out_path out_dir)
+  set(_virtual_path "")
+  set(_import_dir "")
+  foreach(_dir ${import_dirs})
+    file(RELATIVE_PATH _rel "${_dir}" "${file}")
+    if(NOT _rel MATCHES "^\\.\\./" AND NOT IS_ABSOLUTE "${_rel}")
+      set(_virtual_path "${_rel}")
+      set(_import_dir "${_dir}")
+      break()
+    endif()
+  endforeach()
+  set(${out_path} "${_virtual_path}" PARENT_SCOPE)
+  set(${out_dir} "${_import_dir}" PARENT_SCOPE)
+endfunction()
+
+# Files generated for `virtual_path` (a .proto file name as protoc sees it) under `out_dir`
+function(_protobuf_generate_outputs virtual_path out_dir extensions out_var)
+  get_filename_component(_dir "${virtual_path}" DIRECTORY)
+  get_filename_component(_name "${virtual_path}" NAME)
+  string(REGEX REPLACE "\\.proto$" "" _name "${_name}")
+  if(_dir)
+    set(_dir "${_dir}/")
+  endif()
+  set(_outputs)
+  foreach(_ext ${extensions})
+    list(APPEND _outputs "${out_dir}/${_dir}${_name}${_ext}")
+  endforeach()
+  set(${out_var} "${_outputs}" PARENT_SCOPE)
+endfunction()
+
+# Files `file` imports directly, memoized for the whole configure (or script) run
+function(_protobuf_generate_direct_imports file import_dirs out_files out_unresolved)
+  string(SHA1 _property "${file};${import_dirs}")
+  set(_property "_protobuf_generate_imports_${_property}")
+  get_property(_scanned GLOBAL PROPERTY ${_property} SET)
+  if(NOT _scanned)
+    set(_import_regex "^[ \t]*import[ \t]+(public[ \t]+|weak[ \t]+)?\"([^\"]+)\"")
+    set(_files)
+    set(_unresolved)
+    if(EXISTS "${file}")
+      file(STRINGS "${file}" _import_lines REGEX "${_import_regex}")
+    endif()
+    foreach(_line ${_import_lines})
+      string(REGEX REPLACE "${_import_regex}.*$" "\\2" _name "${_line}")
+      set(_resolved "")
+      foreach(_dir ${import_dirs})
+        if(EXISTS "${_dir}/${_name}")
+          get_filename_component(_resolved "${_dir}/${_name}" ABSOLUTE)
+          break()
+        endif()
+      endforeach()
+      if(_resolved)
+        list(APPEND _files "${_resolved}")
+      else()
+        list(APPEND _unresolved "${_name}")
+      endif()
+    endforeach()
+    set_property(GLOBAL PROPERTY ${_property} "${_files}")
+    set_property(GLOBAL PROPERTY ${_property}_unresolved "${_unresolved}")
+  endif()
+  get_property(_files GLOBAL PROPERTY ${_property})
+  get_property(_unresolved GLOBAL PROPERTY ${_property}_unresolved)
+  set(${out_files} "${_files}" PARENT_SCOPE)
+  set(${out_unresolved} "${_unresolved}" PARENT_SCOPE)
+endfunction()
+
+# Collects the files `proto` imports, transitively, resolved against `import_dirs`.
+# Resolved files go to `out_files` (absolute paths), names that are not found in any
+# import dir go to `out_unresolved`.
+function(_protobuf_generate_imports proto import_dirs out_files out_unresolved)
+  set(_pending "${proto}")
+  set(_files)
+  set(_unresolved)
+  while(_pending)
+    list(GET _pending 0 _file)
+    list(REMOVE_AT _pending 0)
+    _protobuf_generate_direct_imports("${_file}" "${import_dirs}" _direct _direct_unresolved)
+    list(APPEND _unresolved ${_direct_unresolved})
+    foreach(_resolved ${_direct})
+      list(FIND _files "${_resolved}" _index)
+      if(_index EQUAL -1 AND NOT _resolved STREQUAL proto)
+        list(APPEND _files "${_resolved}")
+        list(APPEND _pending "${_resolved}")
+      endif()
+    endforeach()
+  endwhile()
+  if(_unresolved)
+    list(REMOVE_DUPLICATES _unresolved)
+  endif()
+  set(${out_files} "${_files}" PARENT_SCOPE)
+  set(${out_unresolved} "${_unresolved}" PARENT_SCOPE)
+endfunction()
+
+# SHA256 of a binary, computed once per configure
+function(_protobuf_generate_binary_id binary out_var)
+  string(SHA256 _property "${binary}")
+  set(_property "_protobuf_generate_id_${_property}")
+  get_property(_id GLOBAL PROPERTY ${_property})
+  if(NOT _id)
+    if(EXISTS "${binary}")
+      file(SHA256 "${binary}" _id)
+    else()
+      set(_id "${binary}")
+    endif()
+    set_property(GLOBAL PROPERTY ${_property} "${_id}")
+  endif()
+  set(${out_var} "${_id}" PARENT_SCOPE)
+endfunction()
+
+function(_protobuf_generate_find_protoc out_var)
+  if(Protobuf_PROTOC_EXECUTABLE)
+    set(${out_var} "${Protobuf_PROTOC_EXECUTABLE}" PARENT_SCOPE)
+    return()
+  endif()
+  get_property(_module_dir GLOBAL PROPERTY _protobuf_generate_module_dir)
+  if(CMAKE_HOST_WIN32)
+    set(_suffix ".exe")
+  endif()
+  # <package>/lib/cmake/protobuf/protobuf-generate.cmake -> <package>/bin/protoc
+  get_filename_component(_protoc "${_module_dir}/../../../bin/protoc${_suffix}" ABSOLUTE)
+  if(NOT EXISTS "${_protoc}")
+    find_program(_protobuf_generate_protoc NAMES protoc)
+    set(_protoc "${_protobuf_generate_protoc}")
+  endif()
+  set(${out_var} "${_protoc}" PARENT_SCOPE)
+endfunction()
+
+function(_protobuf_generate_write_if_different file content)
+  if(EXISTS "${file}")
+    file(READ "${file}" _current)
+    if(_current STREQUAL content)
+      return()
+    endif()
+  endif()
+  file(WRITE "${file}" "${content}")
+endfunction()
+
+# Adds the custom command of one batch, called from protobuf_generate() and reads its variables
+function(_protobuf_generate_add_batch name protos outputs depends)
+  set(_batch "${CMAKE_CURRENT_BINARY_DIR}/protobuf_generate/${name}")
+  set(_batch_PROTOS "${protos}")
+  set(_batch_STAMP "${_batch}.stamp")
+  set(_manifest "")
+  foreach(_var PROTOC PLUGIN_ARGS LANGUAGE OUT_OPTIONS IMPORT_DIRS OUT_DIR PROTOS EXTENSIONS CACHE_DIR CACHE_KEY STAMP)
+    string(APPEND _manifest "set(${_var} [==[${_batch_${_var}}]==])\n")
+  endforeach()
+  _protobuf_generate_write_if_different("${_batch}.cmake" "${_manifest}")
+  # The manifest hash is part of the command line, so build tools that track commands (Ninja)
+  # rerun the batch when its parameters change, like they do for the per-file commands
+  string(SHA1 _manifest_hash "${_manifest}")
+
+  list(LENGTH protos _count)
+  add_custom_command(
+    OUTPUT "${_batch}.stamp" ${outputs}
+    COMMAND ${CMAKE_COMMAND} "-DBATCH=${_batch}.cmake" "-DBATCH_HASH=${_manifest_hash}" -P "${_module_file}"
+    DEPENDS ${depends}
+    COMMENT "Running ${protobuf_generate_LANGUAGE} protocol buffer compiler on ${_count} files (batch ${name})"
+    VERBATIM )
+endfunction()
+
+function(protobuf_generate)
+  include(CMakeParseArguments)
+
+  set(_options APPEND_PATH)
+  set(_singleargs LANGUAGE OUT_VAR EXPORT_MACRO PROTOC_OUT_DIR PLUGIN PLUGIN_OPTIONS BATCH_SIZE CODEGEN_PROFILE)
+  if(COMMAND target_sources)
+    list(APPEND _singleargs TARGET)
+  endif()
+  set(_multiargs PROTOS IMPORT_DIRS GENERATE_EXTENSIONS)
+
+  cmake_parse_arguments(protobuf_generate "${_options}" "${_singleargs}" "${_multiargs}" "${ARGN}")
+
+  if(NOT protobuf_generate_PROTOS AND NOT protobuf_generate_TARGET)
+    message(SEND_ERROR "Error: protobuf_generate called without any targets or source files")
+    return()
+  endif()
+
+  if(NOT protobuf_generate_OUT_VAR AND NOT protobuf_generate_TARGET)
+    message(SEND_ERROR "Error: protobuf_generate called without a target or output variable")
+    return()
+  endif()
+
+  if(NOT protobuf_generate_LANGUAGE)
+    set(protobuf_generate_LANGUAGE cpp)
+  endif()
+  string(TOLOWER ${protobuf_generate_LANGUAGE} protobuf_generate_LANGUAGE)
+
+  if(NOT protobuf_generate_PROTOC_OUT_DIR)
+    set(protobuf_generate_PROTOC_OUT_DIR ${CMAKE_CURRENT_BINARY_DIR})
+  endif()
+  file(MAKE_DIRECTORY "${protobuf_generate_PROTOC_OUT_DIR}")
+
+  set(_out_options "")
+  if(protobuf_generate_EXPORT_MACRO AND protobuf_generate_LANGUAGE STREQUAL cpp)
+    set(_out_options "dllexport_decl=${protobuf_generate_EXPORT_MACRO}")
+  endif()
+
+  if(NOT protobuf_generate_CODEGEN_PROFILE)
+    set(protobuf_generate_CODEGEN_PROFILE "${PROTOBUF_GENERATE_CODEGEN_PROFILE}")
+  endif()
+  if(NOT protobuf_generate_CODEGEN_PROFILE)
+    set(protobuf_generate_CODEGEN_PROFILE "${protobuf_CODEGEN_PROFILE}")
+  endif()
+  set(_runtime "")
+  if(protobuf_generate_LANGUAGE STREQUAL cpp AND protobuf_generate_CODEGEN_PROFILE AND NOT protobuf_generate_CODEGEN_PROFILE STREQUAL none)
+    if(protobuf_generate_CODEGEN_PROFILE STREQUAL speed)
+      set(_enforce_mode speed)
+      set(_runtime libprotobuf)
+    elseif(protobuf_generate_CODEGEN_PROFILE STREQUAL size)
+      set(_enforce_mode code_size)
+      set(_runtime libprotobuf)
+    elseif(protobuf_generate_CODEGEN_PROFILE STREQUAL lite)
+      set(_enforce_mode lite)
+      set(_runtime libprotobuf-lite)
+    else()
+      message(FATAL_ERROR "protobuf_generate: unknown CODEGEN_PROFILE ${protobuf_generate_CODEGEN_PROFILE}, expected none, speed, size or lite")
+    endif()
+    if(_out_options)
+      set(_out_options "${_enforce_mode},${_out_options}")
+    else()
+      set(_out_options "${_enforce_mode}")
+    endif()
+  endif()
+  if(protobuf_generate_PLUGIN_OPTIONS)
+    if(_out_options)
+      set(_out_options "${_out_options},${protobuf_generate_PLUGIN_OPTIONS}")
+    else()
+      set(_out_options "${protobuf_generate_PLUGIN_OPTIONS}")
+    endif()
+  endif()
+  if(_out_options)
+    set(_out_arg "${_out_options}:${protobuf_generate_PROTOC_OUT_DIR}")
+  else()
+    set(_out_arg "${protobuf_generate_PROTOC_OUT_DIR}")
+  endif()
+
+  if(NOT protobuf_generate_GENERATE_EXTENSIONS)
+    if(protobuf_generate_LANGUAGE STREQUAL cpp)
+      set(protobuf_generate_GENERATE_EXTENSIONS .pb.h .pb.cc)
+    elseif(protobuf_generate_LANGUAGE STREQUAL python)
+      set(protobuf_generate_GENERATE_EXTENSIONS _pb2.py)
+    else()
+      message(SEND_ERROR "Error: protobuf_generate given unknown Language ${protobuf_generate_LANGUAGE}, please provide a value for GENERATE_EXTENSIONS")
+      return()
+    endif()
+  endif()
+
+  if(protobuf_generate_TARGET)
+    get_target_property(_source_list ${protobuf_generate_TARGET} SOURCES)
+    foreach(_file ${_source_list})
+      if(_file MATCHES "proto$")
+        list(APPEND protobuf_generate_PROTOS ${_file})
+      endif()
+    endforeach()
+  endif()
+
+  if(NOT protobuf_generate_PROTOS)
+    message(SEND_ERROR "Error: protobuf_generate could not find any .proto files")
+    return()
+  endif()
+
+  _protobuf_generate_find_protoc(_protoc)
+  if(NOT _protoc)
+    message(SEND_ERROR "Error: protobuf_generate could not find protoc, please set Protobuf_PROTOC_EXECUTABLE")
+    return()
+  endif()
+
+  set(_plugin_args)
+  set(_plugin_path)
+  if(protobuf_generate_PLUGIN)
+    set(_plugin_args "--plugin=${protobuf_generate_PLUGIN}")
+    string(REGEX REPLACE "^[^=]*=" "" _plugin_path "${protobuf_generate_PLUGIN}")
+  endif()
+
+  set(_import_dirs)
+  if(protobuf_generate_APPEND_PATH)
+    # Create an include path for each file specified
+    foreach(_file ${protobuf_generate_PROTOS})
+      get_filename_component(_abs_file ${_file} ABSOLUTE)
+      get_filename_component(_abs_path ${_abs_file} PATH)
+      list(APPEND _import_dirs ${_abs_path})
+    endforeach()
+  else()
+    list(APPEND _import_dirs ${CMAKE_CURRENT_SOURCE_DIR})
+  endif()
+  foreach(DIR ${protobuf_generate_IMPORT_DIRS})
+    get_filename_component(ABS_PATH ${DIR} ABSOLUTE)
+    list(APPEND _import_dirs ${ABS_PATH})
+  endforeach()
+  list(REMOVE_DUPLICATES _import_dirs)
+  set(_protobuf_include_path)
+  foreach(_dir ${_import_dirs})
+    list(APPEND _protobuf_include_path -I ${_dir})
+  endforeach()
+
+  if(NOT protobuf_generate_BATCH_SIZE)
+    set(protobuf_generate_BATCH_SIZE "${PROTOBUF_GENERATE_BATCH_SIZE}")
+  endif()
+  if(NOT DEFINED PROTOBUF_GENERATE_CACHE_DIR)
+    set(PROTOBUF_GENERATE_CACHE_DIR "$ENV{PROTOBUF_GENERATE_CACHE_DIR}")
+  endif()
+  get_property(_module_file GLOBAL PROPERTY _protobuf_generate_module_file)
+  set(_cache_key "")
+  if(PROTOBUF_GENERATE_CACHE_DIR)
+    _protobuf_generate_binary_id("${_protoc}" _protoc_id)
+    set(_plugin_id "")
+    if(_plugin_path)
+      _protobuf_generate_binary_id("${_plugin_path}" _plugin_id)
+    endif()
+    # Everything but the paths of this build tree, so entries are shared between build trees
+    set(_cache_key "language=${protobuf_generate_LANGUAGE} options=${_out_options} protoc=${_protoc_id} plugin=${_plugin_id}")
+  endif()
+
+  # Parameters of the script mode runs, see _protobuf_generate_run()
+  set(_batch_PROTOC "${_protoc}")
+  set(_batch_PLUGIN_ARGS "${_plugin_args}")
+  set(_batch_LANGUAGE "${protobuf_generate_LANGUAGE}")
+  set(_batch_OUT_OPTIONS "${_out_options}")
+  set(_batch_IMPORT_DIRS "${_import_dirs}")
+  set(_batch_OUT_DIR "${protobuf_generate_PROTOC_OUT_DIR}")
+  set(_batch_EXTENSIONS "${protobuf_generate_GENERATE_EXTENSIONS}")
+  set(_batch_CACHE_DIR "${PROTOBUF_GENERATE_CACHE_DIR}")
+  set(_batch_CACHE_KEY "${_cache_key}")
+
+  # The runtimes are only known for packages of the recipe, whose protobuf-options.cmake lists them
+  if(_runtime AND DEFINED protobuf_CONAN_RUNTIMES)
+    list(FIND protobuf_CONAN_RUNTIMES ${_runtime} _index)
+    if(_index EQUAL -1)
+      message(FATAL_ERROR "protobuf_generate: code generated with CODEGEN_PROFILE ${protobuf_generate_CODEGEN_PROFILE} "
+                          "needs ${_runtime}, the protobuf package only has: ${protobuf_CONAN_RUNTIMES}")
+    endif()
+    list(FIND protobuf_CONAN_RUNTIMES libprotobuf _index)
+    if(_runtime STREQUAL libprotobuf-lite AND _index EQUAL -1)
+      foreach(_proto ${protobuf_generate_PROTOS})
+        get_filename_component(_abs_file ${_proto} ABSOLUTE)
+        _protobuf_generate_imports("${_abs_file}" "${_import_dirs}" _imports _unresolved)
+        foreach(_import ${_imports})
+          _protobuf_generate_virtual_path("${_import}" "${_import_dirs}" _import_path _import_dir)
+          if(_import_path MATCHES "^google/protobuf/")
+            message(FATAL_ERROR "protobuf_generate: ${_proto} imports ${_import_path}, its generated code is only "
+                                "in libprotobuf, the protobuf package only has: ${protobuf_CONAN_RUNTIMES}")
+          endif()
+        endforeach()
+      endforeach()
+    endif()
+  endif()
+
+  set(_generated_srcs_all)
+  set(_groups)
+  foreach(_proto ${protobuf_generate_PROTOS})
+    get_filename_component(_abs_file ${_proto} ABSOLUTE)
+    # protoc writes the outputs relative to the import dir that contains the .proto file
+    _protobuf_generate_virtual_path("${_abs_file}" "${_import_dirs}" _virtual_path _import_dir)
+    if(NOT _virtual_path)
+      message(SEND_ERROR "Error: protobuf_generate: ${_proto} is not in any of the import dirs ${_import_dirs}")
+      return()
+    endif()
+    _protobuf_generate_outputs("${_virtual_path}" "${protobuf_generate_PROTOC_OUT_DIR}" "${protobuf_generate_GENERATE_EXTENSIONS}" _generated_srcs)
+    list(APPEND _generated_srcs_all ${_generated_srcs})
+
+    if(protobuf_generate_BATCH_SIZE)
+      string(SHA1 _group "${_import_dir}")
+      string(SUBSTRING "${_group}" 0 12 _group)
+      list(FIND _groups ${_group} _index)
+      if(_index EQUAL -1)
+        list(APPEND _groups ${_group})
+        set(_group_protos_${_group})
+      endif()
+      list(APPEND _group_protos_${_group} "${_abs_file}")
+      continue()
+    endif()
+
+    # Imports found at configure time, a new import is picked up on the next CMake run
+    _protobuf_generate_imports("${_abs_file}" "${_import_dirs}" _imports _unresolved)
+    if(PROTOBUF_GENERATE_CACHE_DIR)
+      set(_run_args)
+      foreach(_var PROTOC PLUGIN_ARGS LANGUAGE OUT_OPTIONS IMPORT_DIRS OUT_DIR EXTENSIONS CACHE_DIR CACHE_KEY)
+        string(REPLACE ";" "$<SEMICOLON>" _value "${_batch_${_var}}")
+        list(APPEND _run_args "-D${_var}=${_value}")
+      endforeach()
+      add_custom_command(
+        OUTPUT ${_generated_srcs}
+        COMMAND ${CMAKE_COMMAND} ${_run_args} "-DPROTOS=${_abs_file}" -P "${_module_file}"
+        DEPENDS ${_abs_file} ${_imports} ${_protoc} ${_plugin_path}
+        COMMENT "Running ${protobuf_generate_LANGUAGE} protocol buffer compiler on ${_proto} (cached)"
+        VERBATIM )
+    else()
+      add_custom_command(
+        OUTPUT ${_generated_srcs}
+        COMMAND ${_protoc}
+        ARGS ${_plugin_args} --${protobuf_generate_LANGUAGE}_out ${_out_arg} ${_protobuf_include_path} ${_abs_file}
+        DEPENDS ${_abs_file} ${_imports} ${_protoc} ${_plugin_path}
+        COMMENT "Running ${protobuf_generate_LANGUAGE} protocol buffer compiler on ${_proto}"
+        VERBATIM )
+    endif()
+  endforeach()
+
+  foreach(_group ${_groups})
+    set(_protos ${_group_protos_${_group}})
+    # Neighbouring files share most of their imports
+    list(SORT _protos)
+    list(LENGTH _protos _count)
+    set(_index 0)
+    set(_batch 0)
+    while(_index LESS _count)
+      math(EXPR _end "${_index} + ${protobuf_generate_BATCH_SIZE}")
+      set(_batch_protos)
+      set(_batch_outputs)
+      set(_batch_depends ${_protoc} ${_plugin_path})
+      while(_index LESS _end AND _index LESS _count)
+        list(GET _protos ${_index} _abs_file)
+        _protobuf_generate_virtual_path("${_abs_file}" "${_import_dirs}" _virtual_path _import_dir)
+        _protobuf_generate_outputs("${_virtual_path}" "${protobuf_generate_PROTOC_OUT_DIR}" "${protobuf_generate_GENERATE_EXTENSIONS}" _generated_srcs)
+        _protobuf_generate_imports("${_abs_file}" "${_import_dirs}" _imports _unresolved)
+        list(APPEND _batch_protos "${_abs_file}")
+        list(APPEND _batch_outputs ${_generated_srcs})
+        list(APPEND _batch_depends "${_abs_file}" ${_imports})
+        math(EXPR _index "${_index} + 1")
+      endwhile()
+      list(REMOVE_DUPLICATES _batch_depends)
+      string(SHA1 _name "${protobuf_generate_PROTOC_OUT_DIR};${protobuf_generate_LANGUAGE}")
+      string(SUBSTRING "${_name}" 0 8 _name)
+      _protobuf_generate_add_batch("${_name}-${_group}-${_batch}" "${_batch_protos}" "${_batch_outputs}" "${_batch_depends}")
+      math(EXPR _batch "${_batch} + 1")
+    endwhile()
+  endforeach()
+
+  set_source_files_properties(${_generated_srcs_all} PROPERTIES GENERATED TRUE)
+  if(protobuf_generate_OUT_VAR)
+    set(${protobuf_generate_OUT_VAR} ${_generated_srcs_all} PARENT_SCOPE)
+  endif()
+  if(protobuf_generate_TARGET)
+    target_sources(${protobuf_generate_TARGET} PRIVATE ${_generated_srcs_all})
+  endif()
+endfunction()
+
+# Cache entry folder of one .proto file
+function(_protobuf_generate_cache_entry proto virtual_path out_var)
+  _protobuf_generate_imports("${proto}" "${IMPORT_DIRS}" _imports _unresolved)
+  file(SHA256 "${proto}" _sha256)
+  set(_key_data "format=${_PROTOBUF_GENERATE_CACHE_FORMAT}\n${CACHE_KEY}\nproto=${virtual_path} ${_sha256}\n")
+  foreach(_import ${_imports})
+    _protobuf_generate_virtual_path("${_import}" "${IMPORT_DIRS}" _import_path _import_dir)
+    file(SHA256 "${_import}" _sha256)
+    string(APPEND _key_data "import=${_import_path} ${_sha256}\n")
+  endforeach()
+  foreach(_name ${_unresolved})
+    string(APPEND _key_data "unresolved=${_name}\n")
+  endforeach()
+  string(SHA256 _key "${_key_data}")
+  string(SUBSTRING "${_key}" 0 2 _prefix)
+  set(${out_var} "${CACHE_DIR}/${_prefix}/${_key}" PARENT_SCOPE)
+endfunction()
+
+# Copies `file` to `destination`. Single file runs must leave fresh outputs for the build tool,
+# batches keep the timestamp of unchanged outputs (the batch stamp is the fresh output).
+function(_protobuf_generate_install file destination)
+  if(STAMP)
+    configure_file("${file}" "${destination}" COPYONLY)
+  else()
+    get_filename_component(_destination_dir "${destination}" DIRECTORY)
+    file(COPY "${file}" DESTINATION "${_destination_dir}")
+    # file(COPY) keeps the timestamps of the copied file
+    file(TOUCH "${destination}")
+  endif()
+endfunction()
+
+# Script mode: one protoc run over PROTOS (a single file, or a batch with STAMP set),
+# skipping the files found in the cache
+function(_protobuf_generate_run)
+  set(_protoc_out_dir "${OUT_DIR}")
+  if(STAMP)
+    # protoc rewrites every output, stage them so unchanged files keep their timestamps
+    set(_protoc_out_dir "${STAMP}.staging")
+    file(REMOVE_RECURSE "${_protoc_out_dir}")
+    file(MAKE_DIRECTORY "${_protoc_out_dir}")
+  endif()
+
+  set(_misses)
+  foreach(_proto ${PROTOS})
+    if(CACHE_DIR)
+      _protobuf_generate_virtual_path("${_proto}" "${IMPORT_DIRS}" _virtual_path _import_dir)
+      _protobuf_generate_cache_entry("${_proto}" "${_virtual_path}" _entry)
+      _protobuf_generate_outputs("${_virtual_path}" "${_entry}" "${EXTENSIONS}" _cached)
+      set(_hit TRUE)
+      foreach(_file ${_cached})
+        if(NOT EXISTS "${_file}")
+          set(_hit FALSE)
+          break()
+        endif()
+      endforeach()
+      if(_hit)
+        _protobuf_generate_outputs("${_virtual_path}" "${OUT_DIR}" "${EXTENSIONS}" _outputs)
+        foreach(_file ${_cached})
+          list(GET _outputs 0 _output)
+          list(REMOVE_AT _outputs 0)
+          _protobuf_generate_install("${_file}" "${_output}")
+        endforeach()
+        continue()
+      endif()
+    endif()
+    list(APPEND _misses "${_proto}")
+  endforeach()
+  if(NOT _misses)
+    if(STAMP)
+      file(REMOVE_RECURSE "${_protoc_out_dir}")
+      file(TOUCH "${STAMP}")
+    endif()
+    return()
+  endif()
+
+  if(OUT_OPTIONS)
+    set(_out_arg "${OUT_OPTIONS}:${_protoc_out_dir}")
+  else()
+    set(_out_arg "${_protoc_out_dir}")
+  endif()
+  set(_include_args)
+  foreach(_dir ${IMPORT_DIRS})
+    list(APPEND _include_args "-I${_dir}")
+  endforeach()
+  execute_process(
+    COMMAND "${PROTOC}" ${PLUGIN_ARGS} "--${LANGUAGE}_out=${_out_arg}" ${_include_args} ${_misses}
+    RESULT_VARIABLE _result)
+  if(NOT _result EQUAL 0)
+    message(FATAL_ERROR "protoc failed (${_result}) on ${_misses}")
+  endif()
+
+  string(RANDOM LENGTH 12 _random)
+  foreach(_proto ${_misses})
+    _protobuf_generate_virtual_path("${_proto}" "${IMPORT_DIRS}" _virtual_path _import_dir)
+    _protobuf_generate_outputs("${_virtual_path}" "${_protoc_out_dir}" "${EXTENSIONS}" _generated)
+    _protobuf_generate_outputs("${_virtual_path}" "${OUT_DIR}" "${EXTENSIONS}" _outputs)
+    if(CACHE_DIR)
+      _protobuf_generate_cache_entry("${_proto}" "${_virtual_path}" _entry)
+      _protobuf_generate_outputs("${_virtual_path}" "${_entry}" "${EXTENSIONS}" _cached)
+    endif()
+    foreach(_file ${_generated})
+      list(GET _outputs 0 _output)
+      list(REMOVE_AT _outputs 0)
+      if(CACHE_DIR)
+        list(GET _cached 0 _cache_file)
+        list(REMOVE_AT _cached 0)
+      endif()
+      if(NOT EXISTS "${_file}")
+        continue()
+      endif()
+      if(CACHE_DIR)
+        # Copy next to the cache and rename into the entry, so concurrent builds never
+        # see partially written files
+        get_filename_component(_name "${_file}" NAME)
+        get_filename_component(_cache_dir "${_cache_file}" DIRECTORY)
+        file(COPY "${_file}" DESTINATION "${CACHE_DIR}/tmp/${_random}")
+        file(MAKE_DIRECTORY "${_cache_dir}")
+        file(RENAME "${CACHE_DIR}/tmp/${_random}/${_name}" "${_cache_file}")
+      endif()
+      if(STAMP)
+        _protobuf_generate_install("${_file}" "${_output}")
+      endif()
+    endforeach()
+  endforeach()
+  if(CACHE_DIR)
+    file(REMOVE_RECURSE "${CACHE_DIR}/tmp/${_random}")
+  endif()
+  if(STAMP)
+    file(REMOVE_RECURSE "${_protoc_out_dir}")
+    file(TOUCH "${STAMP}")
+  endif()
+endfunction()
+
+if(CMAKE_SCRIPT_MODE_FILE STREQUAL CMAKE_CURRENT_LIST_FILE)
+  if(BATCH)
+    include("${BATCH}")
+  endif()
+  _protobuf_generate_run()
+else()
+  set_property(GLOBAL PROPERTY _protobuf_generate_module_dir "${CMAKE_CURRENT_LIST_DIR}")
+  set_property(GLOBAL PROPERTY _protobuf_generate_module_file "${CMAKE_CURRENT_LIST_FILE}")
+endif()
@@ -1,6 +1,7 @@
-import os, shutil, glob
+import os, shutil, glob, tarfile, tempfile, json, sys, time, pathlib
+from contextlib import contextmanager
 from conans import ConanFile, CMake, tools
-from conans.errors import ConanInvalidConfiguration
+from conans.errors import ConanInvalidConfiguration, ConanException
 from conans.tools import Version
 from conan.tools.files import rename
 from conan.tools.microsoft import msvc_runtime_flag
@@ -22,7 +23,7 @@ class ProtobufConan(ConanFile):
     homepage = "https://github.com/protocolbuffers/protobuf"
     repo_url = 'https://github.com/protocolbuffers/protobuf.git'
     license = "BSD-3-Clause"
-    exports_sources = ["CMakeLists.txt", "protobuf.patch", "patches/*"]
+    exports_sources = ["CMakeLists.txt", "protobuf.patch", "patches/*", "pgo/*", "cmake/*"]
     generators = "cmake", "cmake_paths", "virtualenv"
     short_paths = True
     settings = "os_build", "os", "arch", "compiler", "build_type"
@@ -30,15 +31,41 @@ class ProtobufConan(ConanFile):
         "shared": [True, False],
         "fPIC": [True, False],
         "with_zlib": [True, False],
+        "zlib_backend": ["zlib", "zlib-ng"],
         "with_rtti": [True, False],
         "lite": [True, False],
+        "protoc_mode": ["build", "tool", "external"],
+        "compiler_cache": ["none", "ccache", "sccache"],
+        "lto": ["off", "thin", "full"],
+        "pgo": ["off", "generate", "use"],
+        "allocator": ["system", "tcmalloc", "jemalloc", "mimalloc"],
+        "arenas_by_default": [True, False],
+        "codegen_profile": ["none", "speed", "size", "lite"],
+        "ninja": [True, False],
+        "build_jobs": "ANY",
+        "unity_build": [True, False],
+        "unity_batch_size": "ANY",
+        "pch": [True, False],
     }
     default_options = {
         "shared": False,
         "fPIC": True,
-        "with_zlib": False, # TODO: use our custom zlib version
+        "with_zlib": False,
+        "zlib_backend": "zlib",
         "with_rtti": True,
         "lite": False,
+        "protoc_mode": "build",
+        "compiler_cache": "none",
+        "lto": "off",
+        "pgo": "off",
+        "allocator": "system",
+        "arenas_by_default": False,
+        "codegen_profile": "none",
+        "ninja": False,
+        "build_jobs": "auto",
+        "unity_build": False,
+        "unity_batch_size": 8,
+        "pch": False,
     }
 
     @property
@@ -61,31 +88,221 @@ class ProtobufConan(ConanFile):
     def _is_clang_x86(self):
         return self.settings.compiler == "clang" and self.settings.arch == "x86"
 
-    def cmake_flags(self):
+    @property
+    def _pgo_profile_folder(self):
+        return os.path.join(self.build_folder, "pgo_profile")
+
+    # pgo=generate packages: relative to the working directory of the instrumented consumer process,
+    # GCOV_PREFIX (gcc) and LLVM_PROFILE_FILE (clang) redirect it at run time
+    _pgo_consumer_profile_folder = "protobuf_pgo_profile"
+
+    @property
+    def _exe_suffix(self):
+        return ".exe" if self.settings.os == "Windows" else ""
+
+    def _optimization_flags(self, pgo_stage):
+        flags = []
+        if self.options.lto != "off":
+            if self.settings.compiler == "clang":
+                flags.append("-flto={}".format(self.options.lto))
+            else:
+                # gcc has no ThinLTO, its default partitioned (WHOPR) mode is the closest match
+                flags.append("-flto")
+                if self.options.lto == "full":
+                    flags.append("-flto-partition=one")
+                # Keep regular object code next to the IR, so consumers without -flto can still link
+                flags.append("-ffat-lto-objects")
+        profile_folder = self._pgo_profile_folder.replace("\\", "/")
+        if pgo_stage == "generate":
+            # The build folder is gone when a packaged instrumented library (pgo=generate) runs
+            if self.options.pgo == "generate":
+                profile_folder = self._pgo_consumer_profile_folder
+                if self.settings.compiler == "gcc" and Version(self.settings.compiler.version) >= "11":
+                    # gcc names the .gcda files after the absolute object path, too long for one file name
+                    flags.append("-fprofile-prefix-path={}".format(self.build_folder.replace("\\", "/")))
+            flags.append("-fprofile-generate={}".format(profile_folder))
+        elif pgo_stage == "use":
+            if self.settings.compiler == "clang":
+                flags.append("-fprofile-use={}/protobuf.profdata".format(profile_folder))
+            else:
+                flags.extend(["-fprofile-use={}".format(profile_folder), "-fprofile-correction", "-Wno-missing-profile"])
+        return flags
+
+    def _lto_tool(self, name):
+        # gcc-ar/llvm-ar and friends load the LTO plugin, plain ar/ranlib do not understand the IR
+        prefix = "llvm-" if self.settings.compiler == "clang" else "gcc-"
+        major = str(self.settings.compiler.version).split(".")[0]
+        for candidate in ["{}{}-{}".format(prefix, name, major), prefix + name]:
+            path = tools.which(candidate)
+            if path:
+                return path.replace("\\", "/")
+        raise ConanException("lto={} requires {}{} in PATH".format(self.options.lto, prefix, name))
+
+    def cmake_flags(self, pgo_stage=None):
+        if pgo_stage is None and self.options.pgo != "off":
+            pgo_stage = str(self.options.pgo)
 
         # Generate the CMake flags to ensure the UE4-bundled version of zlib is used
         #from ue4util import Utility
         #zlib = self.deps_cpp_info["zlib"]
-        return [
-            "-DBUILD_SHARED_LIBS=OFF",
+        # BUILD_SHARED_LIBS follows the shared option, the CMake build helper defines it (user args would override it)
+        flags = [
             #"-Dprotobuf_BUILD_TESTS=OFF",
             #"-Dprotobuf_MSVC_STATIC_RUNTIME=OFF",
             #"-DZLIB_INCLUDE_DIR=" + zlib.include_paths[0],
             #"-DZLIB_LIBRARY=" + Utility.resolve_file(zlib.lib_paths[0], zlib.libs[0])
         ]
 
+        optimization_flags = self._optimization_flags(pgo_stage)
+        if optimization_flags:
+            # Setting CMAKE_<LANG>_FLAGS disables CMake's own CFLAGS/CXXFLAGS/LDFLAGS lookup, keep the profile ones
+            for variable, env_var in [("CMAKE_C_FLAGS", "CFLAGS"), ("CMAKE_CXX_FLAGS", "CXXFLAGS"),
+                                      ("CMAKE_EXE_LINKER_FLAGS", "LDFLAGS"), ("CMAKE_SHARED_LINKER_FLAGS", "LDFLAGS")]:
+                value = " ".join([os.environ.get(env_var, "")] + optimization_flags).strip()
+                flags.append("-D{}={}".format(variable, value))
+        return flags
+
+    _build_report_name = "conan_build_report.json"
+
+    def _load_build_report(self, folder):
+        path = os.path.join(folder, self._build_report_name)
+        self._build_report = json.loads(tools.load(path)) if os.path.isfile(path) else {"phases": []}
+        self._build_report_stack = []
+
+    def _save_build_report(self, path):
+        tools.save(path, json.dumps(self._build_report, indent=2, sort_keys=True))
+
+    @staticmethod
+    def _children_max_rss_kb():
+        try:
+            import resource
+        except ImportError: # Windows
+            return None
+        max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return max_rss // 1024 if sys.platform == "darwin" else max_rss
+
+    @contextmanager
+    def _timed(self, phase):
+        # Nested phases are reported as "build/cmake.build", "package/cmake.install", ...
+        self._build_report_stack.append(phase)
+        name = "/".join(self._build_report_stack)
+        start_wall, start_times = time.time(), os.times()
+        try:
+            yield
+        finally:
+            end_times = os.times()
+            self._build_report["phases"].append({
+                "name": name,
+                "wall_s": round(time.time() - start_wall, 3),
+                "cpu_s": round(max(0.0, end_times[0] + end_times[1] - start_times[0] - start_times[1]), 3),
+                "children_cpu_s": round(max(0.0, end_times[2] + end_times[3] - start_times[2] - start_times[3]), 3),
+                # ru_maxrss of children is a high-water mark over all child processes finished so far
+                "children_max_rss_kb": self._children_max_rss_kb(),
+            })
+            self._build_report_stack.pop()
+
+    def _replace_in_file(self, file_path, search, replace):
+        with self._timed("replace_in_file:{}".format(os.path.relpath(file_path, self._source_subfolder).replace("\\", "/"))):
+            # strict: a protobuf version without the anchor must fail the build, not drop the patch
+            tools.replace_in_file(file_path, search, replace, strict=True)
+
+    def _ninja_compile_times(self):
+        # .ninja_log v5: start_ms end_ms mtime output hash, later lines win for rebuilt outputs
+        ninja_log = os.path.join(self.build_folder, self._build_subfolder, ".ninja_log")
+        if not os.path.isfile(ninja_log):
+            return None
+        outputs = {}
+        for line in tools.load(ninja_log).splitlines():
+            fields = line.split("\t")
+            if len(fields) == 5:
+                outputs[fields[3]] = (int(fields[1]) - int(fields[0])) / 1000.0
+        targets = {}
+        for output, seconds in outputs.items():
+            # CMakeFiles/<target>.dir/<source>.o
+            parts = output.split("/")
+            target = parts[1][:-len(".dir")] if len(parts) > 2 and parts[0] == "CMakeFiles" else output
+            entry = targets.setdefault(target, {"seconds": 0.0, "outputs": 0})
+            entry["seconds"] = round(entry["seconds"] + seconds, 3)
+            entry["outputs"] += 1
+        slowest = sorted(outputs.items(), key=lambda item: item[1], reverse=True)[:20]
+        return {
+            "targets": targets,
+            "slowest_outputs": [{"output": output, "seconds": seconds} for output, seconds in slowest],
+        }
+
+    @property
+    def _source_mirror(self):
+        # Local bare mirror (plain path or file:// URL) used instead of `repo_url`
+        mirror = tools.get_env("CONAN_PROTOBUF_MIRROR")
+        if mirror and os.path.isdir(mirror):
+            # git ignores --depth for plain local paths and hardlinks the whole object store
+            return pathlib.Path(os.path.abspath(mirror)).as_uri()
+        return mirror
+
+    @property
+    def _source_cache_folder(self):
+        # Folder with `<name>-<version>-<sha256>.tar.gz` snapshots of the cloned sources
+        return tools.get_env("CONAN_PROTOBUF_SOURCE_CACHE")
+
+    def _source_tarball_prefix(self):
+        return "{}-{}-".format(self.name, self.version)
+
+    def _find_cached_source(self, cache_folder):
+        prefix = self._source_tarball_prefix()
+        for tarball in sorted(glob.glob(os.path.join(cache_folder, prefix + "*.tar.gz"))):
+            sha256 = os.path.basename(tarball)[len(prefix):-len(".tar.gz")]
+            try:
+                tools.check_sha256(tarball, sha256)
+            except ConanException:
+                self.output.warn("Ignoring corrupted source tarball: %s" % (tarball))
+                continue
+            return tarball
+        return None
+
+    def _store_cached_source(self, cache_folder):
+        tools.mkdir(cache_folder)
+        handle, tmp_tarball = tempfile.mkstemp(dir=cache_folder, suffix=".tmp")
+        os.close(handle)
+        try:
+            with tarfile.open(tmp_tarball, "w:gz") as tgz:
+                # git metadata is not needed to build and can be large even with --depth 1
+                tgz.add(self._source_subfolder,
+                        filter=lambda info: None if os.path.basename(info.name) == ".git" else info)
+            tarball = os.path.join(cache_folder, "{}{}.tar.gz".format(self._source_tarball_prefix(),
+                                                                      tools.sha256sum(tmp_tarball)))
+            # rename is atomic, so concurrent builds never see a partially written tarball
+            os.replace(tmp_tarball, tarball)
+        finally:
+            if os.path.exists(tmp_tarball):
+                os.remove(tmp_tarball)
+        self.output.info("Stored sources in cache: %s" % (tarball))
+
     def source(self):
         #tools.get(**self.conan_data["sources"][self.version])
         #extracted_folder = self.name + "-" + self.version
         #os.rename(extracted_folder, self._source_subfolder)
-        self.run('git clone --progress --depth 1 --branch {} --recursive --recurse-submodules {} {}'.format(self.version, self.repo_url, self._source_subfolder))
+        self._load_build_report(".")
+        with self._timed("source"):
+            cache_folder = self._source_cache_folder
+            tarball = self._find_cached_source(cache_folder) if cache_folder else None
+            if tarball:
+                self.output.info("Using cached sources: %s" % (tarball))
+                with self._timed("extract"):
+                    tools.unzip(tarball)
+            else:
+                url = self._source_mirror or self.repo_url
+                with self._timed("git_clone"):
+                    # No submodules: googletest and benchmark are only needed by protobuf_BUILD_TESTS, and their
+                    # .gitmodules URLs point to GitHub even when cloning from the mirror
+                    self.run('git clone --progress --depth 1 --branch {} {} {}'.format(self.version, url, self._source_subfolder))
+                if cache_folder:
+                    with self._timed("store_cached_source"):
+                        self._store_cached_source(cache_folder)
 
-        # Prevent libprotobuf-lite from being included in our built package
-        tools.replace_in_file(
-            self._source_subfolder + "/cmake/install.cmake",
-            "set(_protobuf_libraries libprotobuf-lite libprotobuf)",
-            "set(_protobuf_libraries libprotobuf)"
-        )
+            # Patches don't depend on options (option specific behaviour is switched by CMake definitions),
+            # so all configurations can be built from the one patched tree, see build_matrix.py
+            self._patch_sources()
+        self._save_build_report(self._build_report_name)
 
     def configure(self):
         if self.options.shared:
@@ -95,6 +312,47 @@ class ProtobufConan(ConanFile):
             if tools.Version(self.version) >= "3.15.4" and tools.Version(self.settings.compiler.version) < "4":
                 raise ConanInvalidConfiguration("protobuf {} doesn't support clang < 4".format(self.version))
 
+        if self.options.lto != "off" or self.options.pgo != "off":
+            if self.settings.compiler not in ["gcc", "clang"] or self._is_clang_cl:
+                raise ConanInvalidConfiguration("lto and pgo are only supported with gcc and clang")
+
+        build_jobs = str(self.options.build_jobs)
+        if build_jobs != "auto" and not (build_jobs.isdigit() and int(build_jobs) > 0):
+            raise ConanInvalidConfiguration("build_jobs must be 'auto' or a positive number of jobs, not '{}'".format(build_jobs))
+
+        # 0 would be CMake's "one unity file per target", the memory bound is the point of batching
+        unity_batch_size = str(self.options.unity_batch_size)
+        if not (unity_batch_size.isdigit() and int(unity_batch_size) > 0):
+            raise ConanInvalidConfiguration("unity_batch_size must be a positive number of sources per unity file, "
+                                            "not '{}'".format(unity_batch_size))
+
+        if self.options.allocator == "mimalloc":
+            # Replace malloc/free and new/delete of the whole process, not only mi_malloc
+            self.options["mimalloc"].override = True
+
+        if not self.options.with_zlib:
+            del self.options.zlib_backend
+        elif self.options.zlib_backend == "zlib-ng":
+            # GzipInputStream/GzipOutputStream use the zlib API, zlib-ng provides it in compat mode
+            self.options["zlib-ng"].zlib_compat = True
+
+        if getattr(self, "settings_target", None) is not None:
+            # Resolved as a build requirement, e.g. by protoc_mode=external: only protoc runs on the build machine.
+            # The options of the build profile (-o:b) don't reach this self reference, so it can't be asked for
+            self.options.protoc_mode = "tool"
+        if self.options.protoc_mode == "tool" and self.options.lite:
+            raise ConanInvalidConfiguration("protoc_mode=tool packages protoc, it can't be combined with lite")
+        if self.options.protoc_mode == "external" and not hasattr(self, "settings_build"):
+            raise ConanInvalidConfiguration("protoc_mode=external takes protoc from the build context, "
+                                            "pass a build profile (-pr:b)")
+
+        if self.options.pgo == "use":
+            # The training workload needs protoc and must run on the build machine
+            if not self._packages_protoc:
+                raise ConanInvalidConfiguration("pgo=use can't be combined with lite, protoc is not built")
+            if tools.cross_building(self):
+                raise ConanInvalidConfiguration("pgo=use can't be cross-built, the training workload must run")
+
         if self.settings.os == "Windows" and self.settings.compiler == "Visual Studio":
             compiler_version = Version(self.settings.compiler.version.value)
             if compiler_version < "14":
@@ -122,8 +380,63 @@ class ProtobufConan(ConanFile):
             del self.options.with_rtti
 
     def requirements(self):
+        # protoc is linked statically and zlib-less, the allocator is applied to consumers of the runtime
+        if self.options.protoc_mode == "tool":
+            return
         if self.options.with_zlib:
-            self.requires("zlib/1.2.11")
+            if self.options.zlib_backend == "zlib-ng":
+                self.requires("zlib-ng/2.0.6")
+            else:
+                self.requires("zlib/1.2.11")
+        # tcmalloc comes from the system gperftools (libtcmalloc), see package_info()
+        if self.options.allocator == "jemalloc":
+            self.requires("jemalloc/5.2.1")
+        elif self.options.allocator == "mimalloc":
+            self.requires("mimalloc/2.0.6")
+
+    def build_requirements(self):
+        if self.options.ninja and not tools.which("ninja"):
+            self.build_requires("ninja/1.10.2")
+        if self.options.protoc_mode == "external":
+            # protobuf for the build machine in protoc_mode=tool (see configure()), built once and shared by every
+            # target configuration
+            try:
+                reference = "{}/{}@{}/{}".format(self.name, self.version, self.user, self.channel)
+            except ConanException: # created without user/channel
+                reference = "{}/{}@".format(self.name, self.version)
+            self.build_requires(reference)
+
+    @property
+    def _builds_protoc(self):
+        return not self.options.lite and self.options.protoc_mode != "external"
+
+    @property
+    def _packages_protoc(self):
+        return self._builds_protoc or self.options.protoc_mode == "external"
+
+    @property
+    def _external_protoc(self):
+        return self.user_info_build["protobuf"].PROTOC_BIN
+
+    @property
+    def _zlib_dependency(self):
+        return str(self.options.zlib_backend)
+
+    @property
+    def _zlib_library(self):
+        # deps_cpp_info has link names (z, zlib, zlibstatic, zlibd, ...), FindZLIB wants the file: static, import
+        # (MSVC, MinGW) or shared library
+        zlib = self.deps_cpp_info[self._zlib_dependency]
+        candidates = [pattern.format(lib) for lib in zlib.libs
+                      for pattern in ["lib{}.a", "{}.lib", "lib{}.dll.a", "{}.a", "lib{}.so", "lib{}.dylib"]]
+        for lib_path in zlib.lib_paths:
+            for candidate in candidates:
+                library = os.path.join(lib_path, candidate)
+                if os.path.isfile(library):
+                    return library
+        self.output.warn("{} library not found in {} (tried {}), FindZLIB searches ZLIB_ROOT".format(
+            self._zlib_dependency, ", ".join(zlib.lib_paths), ", ".join(candidates)))
+        return None
 
     @property
     def _cmake_install_base_path(self):
@@ -133,8 +446,80 @@ class ProtobufConan(ConanFile):
     def _can_disable_rtti(self):
         return tools.Version(self.version) >= "3.15.4"
 
-    def _configure_cmake(self):
-        cmake = CMake(self)
+    @property
+    def _compiler_cache_folder(self):
+        # Shared by all builds of the recipe, unlike the random `short_paths` build folders
+        return tools.get_env("CONAN_PROTOBUF_COMPILER_CACHE_DIR",
+                             os.path.join(os.path.expanduser("~"), ".conan", "compiler_cache", str(self.options.compiler_cache)))
+
+    @property
+    def _compiler_cache_env(self):
+        if self.options.compiler_cache == "ccache":
+            return {
+                "CCACHE_DIR": tools.get_env("CCACHE_DIR", self._compiler_cache_folder),
+                # Rewrite absolute paths below the build folder to relative ones before hashing
+                "CCACHE_BASEDIR": self.build_folder,
+                # Do not hash the current directory that ends up in the debug info
+                "CCACHE_NOHASHDIR": "1",
+            }
+        if self.options.compiler_cache == "sccache":
+            return {"SCCACHE_DIR": tools.get_env("SCCACHE_DIR", self._compiler_cache_folder)}
+        return {}
+
+    @property
+    def _compiler_cache_launcher(self):
+        launcher = tools.which(str(self.options.compiler_cache))
+        if not launcher:
+            raise ConanException("compiler_cache={0} requires '{0}' in PATH".format(self.options.compiler_cache))
+        return launcher.replace("\\", "/")
+
+    @property
+    def _cmake_generator(self):
+        return "Ninja" if self.options.ninja else None
+
+    # Peak memory of one compiler process on the biggest protobuf/protoc translation units (descriptor.cc & co)
+    _compile_job_memory_mb = 1024
+
+    @staticmethod
+    def _available_memory_mb():
+        if not os.path.isfile("/proc/meminfo"):
+            return None
+        meminfo = tools.load("/proc/meminfo")
+        available = [int(line.split()[1]) // 1024 for line in meminfo.splitlines() if line.startswith("MemAvailable:")]
+        # Containers see the host memory in /proc/meminfo, their limit is in the cgroup (v2, then v1)
+        for limit_file, usage_file in [("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                       ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")]:
+            if os.path.isfile(limit_file) and os.path.isfile(usage_file):
+                limit = tools.load(limit_file).strip()
+                if limit.isdigit():
+                    available.append((int(limit) - int(tools.load(usage_file).strip())) // (1024 * 1024))
+                break
+        return min(available) if available else None
+
+    @property
+    def _build_jobs(self):
+        if self.options.build_jobs != "auto":
+            return int(str(self.options.build_jobs))
+        # cpu_count() honors CONAN_CPU_COUNT, which build_matrix.py uses to split the cores
+        cores = tools.cpu_count()
+        memory_mb = self._available_memory_mb()
+        if memory_mb is None:
+            return cores
+        # Builds running at the same time (build_matrix.py) see the same free memory, each one gets its share
+        memory_mb //= max(1, int(tools.get_env("CONAN_PROTOBUF_PARALLEL_BUILDS", "1")))
+        job_memory_mb = self._compile_job_memory_mb * (2 if self.options.lto != "off" else 1)
+        jobs = max(1, min(cores, memory_mb // job_memory_mb))
+        self.output.info("Building with %d jobs (%d cores, %d MB available, %d MB per job)" % (jobs, cores, memory_mb, job_memory_mb))
+        return jobs
+
+    def _configure_cmake(self, pgo_stage=None):
+        cmake = CMake(self, generator=self._cmake_generator)
+        if self.options.lto != "off":
+            cmake.definitions["CMAKE_AR"] = self._lto_tool("ar")
+            cmake.definitions["CMAKE_RANLIB"] = self._lto_tool("ranlib")
+        if self.options.compiler_cache != "none":
+            cmake.definitions["CMAKE_C_COMPILER_LAUNCHER"] = self._compiler_cache_launcher
+            cmake.definitions["CMAKE_CXX_COMPILER_LAUNCHER"] = self._compiler_cache_launcher
         if self._is_msvc or self._is_clang_cl:
             runtime = msvc_runtime_flag(self)
             if not runtime:
@@ -149,31 +534,138 @@ class ProtobufConan(ConanFile):
         cmake.definitions["CMAKE_INSTALL_CMAKEDIR"] = self._cmake_install_base_path.replace("\\", "/")
         cmake.definitions["protobuf_BUILD_LIBPROTOC"] = True
         cmake.definitions["protobuf_BUILD_TESTS"] = False
-        cmake.definitions["protobuf_WITH_ZLIB"] = self.options.with_zlib
-        cmake.definitions["protobuf_BUILD_PROTOC_BINARIES"] = not self.options.lite
+        cmake.definitions["protobuf_WITH_ZLIB"] = self.options.with_zlib and self.options.protoc_mode != "tool"
+        if self.options.with_zlib and self.options.protoc_mode != "tool":
+            # FindZLIB would take the system zlib: search the requirement first and pin the library file when its
+            # name is a known one, find_package(ZLIB REQUIRED) fails if neither finds it
+            zlib = self.deps_cpp_info[self._zlib_dependency]
+            cmake.definitions["ZLIB_ROOT"] = zlib.rootpath.replace("\\", "/")
+            cmake.definitions["ZLIB_INCLUDE_DIR"] = zlib.include_paths[0].replace("\\", "/")
+            zlib_library = self._zlib_library
+            if zlib_library:
+                cmake.definitions["ZLIB_LIBRARY"] = zlib_library.replace("\\", "/")
+        cmake.definitions["protobuf_BUILD_PROTOC_BINARIES"] = self._builds_protoc
+        if self.options.protoc_mode == "tool":
+            cmake.definitions["BUILD_SHARED_LIBS"] = False
         cmake.definitions["protobuf_BUILD_PROTOBUF_LITE"] = self.options.lite
-        cmake.configure(source_folder=self._source_subfolder + "/cmake", build_folder=self._build_subfolder, args=self.cmake_flags())
+        cmake.definitions["protobuf_CONAN_ARENAS_BY_DEFAULT"] = self.options.arenas_by_default
+        if self.options.unity_build:
+            cmake.definitions["CMAKE_UNITY_BUILD"] = True
+            cmake.definitions["CMAKE_UNITY_BUILD_BATCH_SIZE"] = int(str(self.options.unity_batch_size))
+        cmake.definitions["protobuf_CONAN_PCH"] = self.options.pch
+        with self._timed("cmake.configure"):
+            cmake.configure(source_folder=self._source_subfolder + "/cmake", build_folder=self._build_subfolder, args=self.cmake_flags(pgo_stage))
         return cmake
 
+    def _train_pgo_profile(self):
+        # Instrumented build, the final build reuses the same folder so gcc finds its .gcda files again
+        tools.rmdir(self._pgo_profile_folder)
+        cmake = self._configure_cmake(pgo_stage="generate")
+        with self._timed("cmake.build"):
+            cmake.build()
+
+        build_folder = os.path.join(self.build_folder, self._build_subfolder)
+        training = CMake(self, generator=self._cmake_generator)
+        protoc = os.path.join(build_folder, "protoc" + self._exe_suffix) if self._builds_protoc else self._external_protoc
+        if not os.path.isfile(protoc):
+            raise ConanException("pgo=use: instrumented protoc not found: {}".format(protoc))
+        training.definitions["PROTOBUF_PROTOC"] = protoc.replace("\\", "/")
+        training.definitions["PROTOBUF_INCLUDE_DIR"] = os.path.join(self.source_folder, self._source_subfolder, "src").replace("\\", "/")
+        training.definitions["PROTOBUF_LIBRARY"] = self._pgo_training_library(build_folder).replace("\\", "/")
+        # shared builds: the DLLs are next to the libraries, the ELF/Mach-O ones are found through the build RPATH
+        with self._timed("training"), tools.environment_append({"PATH": [build_folder]}):
+            training.configure(source_folder="pgo", build_folder="pgo_build_subfolder", args=self.cmake_flags(pgo_stage="generate"))
+            training.build()
+            self.run(os.path.join(self.build_folder, "pgo_build_subfolder", "protobuf_training" + self._exe_suffix))
+
+        if self.settings.compiler == "clang":
+            raw_profiles = glob.glob(os.path.join(self._pgo_profile_folder, "*.profraw"))
+            self.run("llvm-profdata merge -output={} {}".format(
+                os.path.join(self._pgo_profile_folder, "protobuf.profdata"), " ".join(raw_profiles)))
+
+    @staticmethod
+    def _pgo_training_library(build_folder):
+        # Static, MinGW import, MSVC-style, shared; with and without the Debug postfix
+        candidates = [pattern.format(lib) for lib in ["protobuf", "protobufd"]
+                      for pattern in ["lib{}.dll.a", "lib{}.a", "{}.lib", "lib{}.so", "lib{}.dylib"]]
+        for candidate in candidates:
+            library = os.path.join(build_folder, candidate)
+            if os.path.isfile(library):
+                return library
+        raise ConanException("pgo=use: instrumented libprotobuf not found in {} (tried {})".format(
+            build_folder, ", ".join(candidates)))
+
+    # Unity builds (relative to src/google/protobuf): the generated .pb.cc files define the same file-scope tables,
+    # the heavy variants redefine helpers of their lite counterparts, util/ and the Java generator reuse anonymous
+    # namespace names and resolve internal:: differently, generated_message_reflection.cc shares IsMapFieldInApi()
+    # with dynamic_message.cc since its helpers left namespace internal. Checked against the 3.8.0 and 3.11.2 sources.
+    _unity_skip_globs = ["*.pb.cc", "util/*.cc", "compiler/java/*.cc"]
+    _unity_skip_sources = ["extension_set_heavy.cc", "generated_message_reflection.cc", "generated_message_table_driven.cc",
+                           "compiler/zip_writer.cc"]
+    # Precompiled headers of libprotobuf-lite, libprotobuf (lite + full) and libprotoc (full + protoc)
+    _pch_lite_headers = ["stubs/common.h", "arena.h", "io/coded_stream.h", "message_lite.h", "repeated_field.h",
+                         "wire_format_lite.h"]
+    _pch_full_headers = ["descriptor.h", "descriptor.pb.h", "message.h", "generated_message_reflection.h"]
+    _pch_protoc_headers = ["io/printer.h", "compiler/code_generator.h", "stubs/strutil.h"]
+
+    def _check_protobuf_files(self, patterns):
+        protobuf_dir = os.path.join(self._source_subfolder, "src", "google", "protobuf")
+        missing = [pattern for pattern in patterns if not glob.glob(os.path.join(protobuf_dir, pattern))]
+        if missing:
+            raise ConanException("CONAN PATCH: {} not found in {}, update the recipe for protobuf {}".format(
+                ", ".join(missing), protobuf_dir, self.version))
+
+    @property
+    def _built_protoc_candidates(self):
+        # Single-config generators (Makefiles, Ninja) and multi-config ones (Visual Studio, Xcode) without a runtime
+        # output directory
+        build_folder = os.path.join(self.build_folder, self._build_subfolder)
+        return [os.path.join(folder, "protoc" + self._exe_suffix)
+                for folder in [build_folder, os.path.join(build_folder, str(self.settings.build_type))]]
+
+    def _check_codegen_profiles(self):
+        # --cpp_out=code_size: comes from the patches of _patch_sources(), fail the build if protoc doesn't have it.
+        # Code generated for CODE_SIZE has no ByteSizeLong(), it serializes through reflection
+        candidates = self._built_protoc_candidates
+        protoc = next((candidate for candidate in candidates if os.path.isfile(candidate)), None)
+        if protoc is None:
+            raise ConanException("codegen check: protoc not found (tried {})".format(", ".join(candidates)))
+        check_folder = os.path.join(self.build_folder, "codegen_check")
+        tools.save(os.path.join(check_folder, "check.proto"), 'syntax = "proto3";\nmessage Check {\n  int32 value = 1;\n}\n')
+        generated = {}
+        with tools.chdir(check_folder), tools.environment_append({"PATH": [os.path.dirname(protoc)]}):
+            for profile in ["speed", "code_size"]:
+                tools.mkdir(profile)
+                try:
+                    self.run('"{}" --cpp_out={}:{} check.proto'.format(protoc, profile, profile))
+                except ConanException:
+                    raise ConanException("protoc rejects --cpp_out={}:, the codegen_profile patches of _patch_sources() "
+                                         "did not apply to protobuf {}".format(profile, self.version))
+                generated[profile] = tools.load(os.path.join(profile, "check.pb.cc"))
+        if "ByteSizeLong" not in generated["speed"] or "ByteSizeLong" in generated["code_size"]:
+            raise ConanException("protoc accepts --cpp_out=code_size: but doesn't generate CODE_SIZE code, "
+                                 "check the EnforceOptimizeMode patches of _patch_sources()")
+
     def _patch_sources(self):
         # for ver. 3.12.4: upstream-pr-7761-cmake-regex-fix.patch
         # for ver. 3.12.4: upstream-issue-7567-no-export-template-define.patch
         #for patch in self.conan_data.get("patches", {}).get(self.version, []):
         #    tools.patch(**patch)
 
-        tools.replace_in_file(
-            os.path.join(self._source_subfolder, "cmake", "protobuf-config.cmake.in"),
-            "@_protobuf_FIND_ZLIB@",
-            "# CONAN PATCH _protobuf_FIND_ZLIB@"
+        # with_zlib must not silently build without GzipInputStream/GzipOutputStream when zlib isn't found
+        self._replace_in_file(
+            os.path.join(self._source_subfolder, "cmake", "CMakeLists.txt"),
+            "  find_package(ZLIB)\n",
+            "  find_package(ZLIB REQUIRED)\n"
         )
-        tools.replace_in_file(
+        self._replace_in_file(
             os.path.join(self._source_subfolder, "cmake", "protobuf-config.cmake.in"),
             "include(\"${CMAKE_CURRENT_LIST_DIR}/protobuf-targets.cmake\")",
             "# CONAN PATCH include(\"${CMAKE_CURRENT_LIST_DIR}/protobuf-targets.cmake\")"
         )
         if 0: # TODO: FIXME
             if tools.Version(self.version) < "3.12.0":
-                tools.replace_in_file(
+                self._replace_in_file(
                     os.path.join(self._source_subfolder, "cmake", "protobuf-config.cmake.in"),
                     """COMMAND  protobuf::protoc
         ARGS --${protobuf_generate_LANGUAGE}_out ${_dll_export_decl}${protobuf_generate_PROTOC_OUT_DIR} ${_protobuf_include_path} ${_abs_file}
@@ -183,7 +675,7 @@ class ProtobufConan(ConanFile):
         DEPENDS ${_abs_file} USES_TERMINAL"""
                 )
             else:
-                tools.replace_in_file(
+                self._replace_in_file(
                     os.path.join(self._source_subfolder, "cmake", "protobuf-config.cmake.in"),
                     """COMMAND  protobuf::protoc
         ARGS --${protobuf_generate_LANGUAGE}_out ${_dll_export_decl}${protobuf_generate_PROTOC_OUT_DIR} ${_plugin} ${_protobuf_include_path} ${_abs_file}
@@ -193,40 +685,171 @@ class ProtobufConan(ConanFile):
         DEPENDS ${_abs_file} USES_TERMINAL"""
                 )
 
-        tools.replace_in_file(
+        self._replace_in_file(
             os.path.join(self._source_subfolder, "cmake", "protobuf-module.cmake.in"),
             'if(DEFINED Protobuf_SRC_ROOT_FOLDER)',
             """if(0)
 if(DEFINED Protobuf_SRC_ROOT_FOLDER)""",
         )
-        tools.replace_in_file(
+        self._replace_in_file(
             os.path.join(self._source_subfolder, "cmake", "protobuf-module.cmake.in"),
             '# Define upper case versions of output variables',
             'endif()',
         )
 
+        # protoc generates arena support for every message when built with arenas_by_default,
+        # as if each .proto file had `option cc_enable_arenas = true;` (the default since protobuf 3.14)
+        self._replace_in_file(
+            os.path.join(self._source_subfolder, "src", "google", "protobuf", "compiler", "cpp", "cpp_helpers.h"),
+            """inline bool SupportsArenas(const FileDescriptor* file) {
+  return file->options().cc_enable_arenas();
+}""",
+            """inline bool SupportsArenas(const FileDescriptor* file) {
+#ifdef PROTOBUF_CONAN_ARENAS_BY_DEFAULT
+  return true;
+#else
+  return file->options().cc_enable_arenas();
+#endif
+}""",
+        )
+        # --cpp_out=code_size:<dir> enforces optimize_for = CODE_SIZE, like speed and lite do for their modes
+        cpp_compiler = os.path.join(self._source_subfolder, "src", "google", "protobuf", "compiler", "cpp")
+        self._replace_in_file(
+            os.path.join(cpp_compiler, "cpp_options.h"),
+            """  kLiteRuntime,
+};""",
+            """  kLiteRuntime,
+  kCodeSize,       // Full runtime, reflection based parsing and serialization (CONAN PATCH)
+};""",
+        )
+        self._replace_in_file(
+            os.path.join(cpp_compiler, "cpp_generator.cc"),
+            """    } else if (options[i].first == "lite") {""",
+            """    } else if (options[i].first == "code_size") {
+      file_options.enforce_mode = EnforceOptimizeMode::kCodeSize;
+    } else if (options[i].first == "lite") {""",
+        )
+        self._replace_in_file(
+            os.path.join(cpp_compiler, "cpp_helpers.h"),
+            """    case EnforceOptimizeMode::kLiteRuntime:
+      return FileOptions::LITE_RUNTIME;""",
+            """    case EnforceOptimizeMode::kLiteRuntime:
+      return FileOptions::LITE_RUNTIME;
+    case EnforceOptimizeMode::kCodeSize:
+      return FileOptions::CODE_SIZE;""",
+        )
+
+        libprotoc_cmake = os.path.join(self._source_subfolder, "cmake", "libprotoc.cmake")
+        tools.save(libprotoc_cmake, tools.load(libprotoc_cmake) + textwrap.dedent("""\
+
+            # CONAN PATCH
+            if(protobuf_CONAN_ARENAS_BY_DEFAULT)
+              target_compile_definitions(libprotoc PRIVATE PROTOBUF_CONAN_ARENAS_BY_DEFAULT)
+            endif()
+        """))
+
+        # Unity builds (CMAKE_UNITY_BUILD) concatenate sources, every port_def.inc needs its port_undef.inc
+        port_def = "#include <google/protobuf/port_def.inc>"
+        port_undef = "#include <google/protobuf/port_undef.inc>"
+        for root, _, files in os.walk(os.path.join(self._source_subfolder, "src", "google", "protobuf")):
+            for name in files:
+                if name.endswith(".cc"):
+                    path = os.path.join(root, name)
+                    lines = tools.load(path).splitlines()
+                    if lines.count(port_def) > lines.count(port_undef):
+                        tools.save(path, "\n".join(lines + [port_undef, ""]))
+        self._check_protobuf_files(self._unity_skip_globs + self._unity_skip_sources + self._pch_lite_headers +
+                                   self._pch_full_headers + self._pch_protoc_headers)
+        protobuf_dir = "${protobuf_source_dir}/src/google/protobuf/"
+        cmakelists = os.path.join(self._source_subfolder, "cmake", "CMakeLists.txt")
+        tools.save(cmakelists, tools.load(cmakelists) + textwrap.dedent("""\
+
+            # CONAN PATCH
+            # Sources that can't share a unity translation unit, see ProtobufConan._unity_skip_globs
+            file(GLOB_RECURSE _conan_unity_skip
+              {unity_skip_globs})
+            list(APPEND _conan_unity_skip
+              {unity_skip_sources})
+            set_source_files_properties(${{_conan_unity_skip}} PROPERTIES SKIP_UNITY_BUILD_INCLUSION ON)
+
+            if(protobuf_CONAN_PCH)
+              if(CMAKE_VERSION VERSION_LESS 3.16)
+                message(WARNING "protobuf_CONAN_PCH needs CMake 3.16, building without precompiled headers")
+              else()
+                set(_conan_pch_lite
+                  <string> <vector> <map>
+                  {pch_lite_headers})
+                set(_conan_pch_full ${{_conan_pch_lite}}
+                  {pch_full_headers})
+                target_precompile_headers(libprotobuf-lite PRIVATE ${{_conan_pch_lite}})
+                target_precompile_headers(libprotobuf PRIVATE ${{_conan_pch_full}})
+                if(TARGET libprotoc)
+                  target_precompile_headers(libprotoc PRIVATE ${{_conan_pch_full}}
+                    {pch_protoc_headers})
+                endif()
+              endif()
+            endif()
+        """).format(
+            unity_skip_globs="\n  ".join('"{}{}"'.format(protobuf_dir, name) for name in self._unity_skip_globs),
+            unity_skip_sources="\n  ".join('"{}{}"'.format(protobuf_dir, name) for name in self._unity_skip_sources),
+            pch_lite_headers=" ".join("<google/protobuf/{}>".format(name) for name in self._pch_lite_headers),
+            pch_full_headers=" ".join("<google/protobuf/{}>".format(name) for name in self._pch_full_headers),
+            pch_protoc_headers=" ".join("<google/protobuf/{}>".format(name) for name in self._pch_protoc_headers)))
+
     def build(self):
-        self._patch_sources()
-        with tools.vcvars(self.settings, only_diff=False): # https://github.com/conan-io/conan/issues/6577
+        self._load_build_report(self.source_folder)
+        build_env = dict(self._compiler_cache_env, CONAN_CPU_COUNT=str(self._build_jobs))
+        with self._timed("build"), tools.vcvars(self.settings, only_diff=False), tools.environment_append(build_env): # https://github.com/conan-io/conan/issues/6577
             #tools.patch(base_path=self._source_subfolder, patch_file="protobuf.patch")
+            if self.options.compiler_cache != "none":
+                self.run("{} --zero-stats".format(self.options.compiler_cache))
+            if self.options.pgo == "use":
+                with self._timed("pgo"):
+                    self._train_pgo_profile()
             cmake = self._configure_cmake()
-            cmake.build()
+            with self._timed("cmake.build"):
+                cmake.build()
+            if self._builds_protoc and not tools.cross_building(self):
+                with self._timed("codegen_check"):
+                    self._check_codegen_profiles()
+            if self.options.compiler_cache != "none":
+                self.run("{} --show-stats".format(self.options.compiler_cache))
+        self._save_build_report(os.path.join(self.build_folder, self._build_report_name))
 
     def package(self):
-        with tools.vcvars(self.settings, only_diff=False): # https://github.com/conan-io/conan/issues/6577
+        self._load_build_report(self.build_folder)
+        build_env = dict(self._compiler_cache_env, CONAN_CPU_COUNT=str(self._build_jobs))
+        with self._timed("package"), tools.vcvars(self.settings, only_diff=False), tools.environment_append(build_env): # https://github.com/conan-io/conan/issues/6577
             self.output.info('self.settings.os: %s' % (self.settings.os))
             self.output.info('self.settings.build_type: %s' % (self.settings.build_type))
 
-            self.copy("LICENSE", dst="licenses", src=self._source_subfolder)
-            #self.copy("BUILD", dst="licenses", src=self._source_subfolder)
-            self.copy("*", dst="cmake", src=os.path.join(self._source_subfolder, "cmake"))
+            with self._timed("copy"):
+                self.copy("LICENSE", dst="licenses", src=self._source_subfolder)
+                #self.copy("BUILD", dst="licenses", src=self._source_subfolder)
+                self.copy("*", dst="cmake", src=os.path.join(self._source_subfolder, "cmake"))
             cmake = self._configure_cmake()
-            cmake.install()
+            with self._timed("cmake.install"):
+                cmake.install()
+            # protobuf_generate() with the content-hash cache, the Conan generators don't load protobuf-config.cmake
+            self.copy("protobuf-generate.cmake", dst=self._cmake_install_base_path, src="cmake")
+            if self.options.protoc_mode == "external":
+                # Ship the build machine protoc, PROTOC_BIN and protobuf_generate() find it in bin/
+                with self._timed("copy_protoc"):
+                    self.copy(os.path.basename(self._external_protoc), dst="bin",
+                              src=os.path.dirname(self._external_protoc), keep_path=False)
+            elif self.options.protoc_mode == "tool":
+                # Only the compiler is packaged, the libraries are linked into it
+                for pattern in ["*.a", "*.lib", "*.so*", "*.dylib", "*.dll"]:
+                    tools.remove_files_by_mask(os.path.join(self.package_folder, "lib"), pattern)
+            self._write_codegen_options()
 
             # Do not add DEBUG_POSTFIX on non-Windows https://github.com/protocolbuffers/protobuf/pull/5484
             if self.settings.os == "Linux" and str(self.settings.build_type).lower() == "debug":
-                shutil.copy(src=os.path.join(self.package_folder, "lib", "libprotobufd.a"),  dst=os.path.join(self.package_folder, "lib", "libprotobuf.a"))
-                shutil.copy(src=os.path.join(self.package_folder, "lib", "libprotocd.a"),  dst=os.path.join(self.package_folder, "lib", "libprotoc.a"))
+                with self._timed("copy_debug_libs"):
+                    for lib in ["protobuf", "protobuf-lite", "protoc"]:
+                        debug_lib = os.path.join(self.package_folder, "lib", "lib{}d.a".format(lib))
+                        if os.path.isfile(debug_lib):
+                            shutil.copy(src=debug_lib, dst=os.path.join(self.package_folder, "lib", "lib{}.a".format(lib)))
                 files = [f for f in glob.glob(os.path.join(self.package_folder, "lib") + "/**", recursive=True)]
                 for f in files:
                     self.output.info('protobuf libs: %s' % (f))
@@ -247,9 +870,65 @@ if(DEFINED Protobuf_SRC_ROOT_FOLDER)""",
             #tools.rmdir(os.path.join(self.package_folder, "cmake"))
             tools.rmdir(os.path.join(self.package_folder, "lib", "pkgconfig"))
 
+        # Phase timings of source(), build() and package(), per-target compile times (Ninja builds only)
+        # and the configuration they belong to, to chart build cost across recipe revisions
+        self._build_report["settings"] = {name: str(value) for name, value in self.settings.items()}
+        self._build_report["options"] = {name: str(value) for name, value in self.options.items()}
+        self._build_report["compile_times"] = self._ninja_compile_times()
+        if self._build_report["compile_times"] is None:
+            self._build_report["compile_times_unavailable"] = (
+                "compile times are read from .ninja_log, the {} generator doesn't write one (build with "
+                "-o protobuf:ninja=True)".format(self._cmake_generator or "default"))
+        self._save_build_report(os.path.join(self.package_folder, "metadata", "build_report.json"))
+
+    def _packaged_runtimes(self):
+        runtimes = []
+        for component, lib in [("libprotobuf", "protobuf"), ("libprotobuf-lite", "protobuf-lite")]:
+            for folder in ["lib", "bin"]:
+                # libprotobuf.a, protobufd.lib, libprotobuf.so.20, libprotobuf-lite.dll, ...
+                if glob.glob(os.path.join(self.package_folder, folder, "*{}.*".format(lib))) or \
+                        glob.glob(os.path.join(self.package_folder, folder, "*{}d.*".format(lib))):
+                    runtimes.append(component)
+                    break
+        return runtimes
+
+    def _write_codegen_options(self):
+        # Read by protobuf_generate(), which checks the profile against the runtimes of this package. protoc_mode=tool
+        # packages have no runtimes and one binary serves every codegen_profile (see package_id()), nothing to write
+        if self.options.protoc_mode == "tool":
+            return
+        options_file = os.path.join(self.package_folder, self._cmake_install_base_path, "protobuf-options.cmake")
+        content = tools.load(options_file) if os.path.isfile(options_file) else ""
+        tools.save(options_file, content + textwrap.dedent("""\
+
+            # CONAN: optimize_for of the C++ code generated by protobuf_generate() (none: the .proto files decide)
+            # and the runtime libraries packaged with this protoc
+            set(protobuf_CODEGEN_PROFILE "{}")
+            set(protobuf_CONAN_RUNTIMES "{}")
+        """.format(self.options.codegen_profile, ";".join(self._packaged_runtimes()))))
+
     def package_id(self):
-        del self.info.settings.compiler
-        del self.info.settings.arch
+        # The compiler cache, generator, parallelism, unity builds and precompiled headers only change
+        # how fast the same binaries are built
+        del self.info.options.compiler_cache
+        del self.info.options.ninja
+        del self.info.options.build_jobs
+        del self.info.options.unity_build
+        del self.info.options.unity_batch_size
+        del self.info.options.pch
+        # LTO objects carry compiler specific IR and pgo=generate objects call the profiling runtime of their
+        # compiler (libgcov, clang_rt.profile), neither can be shared across compilers
+        if self.info.options.lto == "off" and self.info.options.pgo != "generate":
+            del self.info.settings.compiler
+        if self.info.options.protoc_mode == "tool":
+            # One protoc per build machine, whichever configuration of the runtime it is used with. os and arch
+            # stay, they are those of the machine protoc runs on
+            del self.info.settings.build_type
+            for option in ["shared", "fPIC", "with_zlib", "zlib_backend", "with_rtti", "lto", "pgo", "allocator",
+                           "codegen_profile"]:
+                delattr(self.info.options, option)
+        else:
+            del self.info.settings.arch
         self.info.include_build_settings()
 
     def package_info(self):
@@ -263,18 +942,72 @@ if(DEFINED Protobuf_SRC_ROOT_FOLDER)""",
             os.path.join(self._cmake_install_base_path, "protobuf-module.cmake"),
             os.path.join(self._cmake_install_base_path, "protobuf-options.cmake"),
         ]
+        # CMakeDeps only reads the build modules of the package, the legacy generators those of the components
         self.cpp_info.set_property("cmake_build_modules", build_modules)
 
-        self.cpp_info.libs = tools.collect_libs(self)
-        self.cpp_info.libs.sort(reverse=True)
+        # Debug libraries keep the "d" postfix except on Linux, where package() copies them without it
+        lib_prefix = "lib" if (self._is_msvc or self._is_clang_cl or self.settings.compiler == "Visual Studio") else ""
+        lib_suffix = "d" if self.settings.build_type == "Debug" and self.settings.os != "Linux" else ""
+
+        # The allocator replaces malloc/new of the whole process, whichever runtime is linked
+        allocator_requires = []
+        if self.options.allocator == "jemalloc":
+            allocator_requires.append("jemalloc::jemalloc")
+        elif self.options.allocator == "mimalloc":
+            allocator_requires.append("mimalloc::mimalloc")
+
+        # pgo=generate libraries are instrumented, their consumers must link the profiling runtime (libgcov,
+        # clang_rt.profile) and write the profiles below the working directory, see _pgo_consumer_profile_folder
+        pgo_link_flags = ["-fprofile-generate"] if self.options.pgo == "generate" else []
 
-        self.cpp_info.includedirs.append(os.path.join(self.package_folder, "include"))
-        self.cpp_info.includedirs.append(self.package_folder)
-        #self.cpp_info.includedirs.append(os.path.join("include", "google"))
+        runtimes = {"libprotobuf": ("protobuf", "protobuf"), "libprotobuf-lite": ("protobuf-lite", "protobuf-lite")}
+        if self.options.protoc_mode == "tool":
+            # The runtime libraries are not packaged, see package()
+            runtimes = {}
+        for component, (lib, pkg_config_name) in runtimes.items():
+            self.cpp_info.components[component].set_property("cmake_target_name", "protobuf::{}".format(component))
+            self.cpp_info.components[component].set_property("pkg_config_name", pkg_config_name)
+            self.cpp_info.components[component].names["cmake_find_package"] = component
+            self.cpp_info.components[component].names["cmake_find_package_multi"] = component
+            self.cpp_info.components[component].libs = [lib_prefix + lib + lib_suffix]
+            self.cpp_info.components[component].requires = list(allocator_requires)
+            self.cpp_info.components[component].exelinkflags = list(pgo_link_flags)
+            self.cpp_info.components[component].sharedlinkflags = list(pgo_link_flags)
+            if self.options.allocator == "tcmalloc":
+                self.cpp_info.components[component].system_libs.append("tcmalloc")
+            if self.settings.os == "Linux":
+                self.cpp_info.components[component].system_libs.append("pthread")
+                if self._is_clang_x86 or "arm" in str(self.settings.arch):
+                    self.cpp_info.components[component].system_libs.append("atomic")
+            if self.settings.os == "Android":
+                self.cpp_info.components[component].system_libs.append("log")
+            if self.settings.os == "Windows":
+                if self.options.shared:
+                    self.cpp_info.components[component].defines = ["PROTOBUF_USE_DLLS"]
+            # protobuf_generate() and the Protobuf_* variables of FindProtobuf
+            self.cpp_info.components[component].builddirs = [self._cmake_install_base_path]
+            for generator in ["cmake", "cmake_find_package", "cmake_find_package_multi"]:
+                self.cpp_info.components[component].build_modules[generator] = build_modules
+        if self.options.with_zlib and runtimes:
+            # gzip_stream.h includes zlib.h, consumers of GzipInputStream/GzipOutputStream need the headers too
+            self.cpp_info.components["libprotobuf"].requires.append("{0}::{0}".format(self._zlib_dependency))
 
-        self.cpp_info.lib_paths.append(os.path.join(self.package_folder, "lib"))
+        # lite builds have neither libprotoc nor protoc, external ones take protoc from the build context
+        if self._builds_protoc and self.options.protoc_mode == "build":
+            self.cpp_info.components["libprotoc"].set_property("cmake_target_name", "protobuf::libprotoc")
+            self.cpp_info.components["libprotoc"].names["cmake_find_package"] = "libprotoc"
+            self.cpp_info.components["libprotoc"].names["cmake_find_package_multi"] = "libprotoc"
+            self.cpp_info.components["libprotoc"].libs = [lib_prefix + "protoc" + lib_suffix]
+            self.cpp_info.components["libprotoc"].requires = ["libprotobuf"]
+            self.cpp_info.components["libprotoc"].exelinkflags = list(pgo_link_flags)
+            self.cpp_info.components["libprotoc"].sharedlinkflags = list(pgo_link_flags)
 
-        self.cpp_info.bin_paths.append(os.path.join(self.package_folder, "bin"))
+        if self._packages_protoc:
+            self.cpp_info.components["protoc"].set_property("cmake_target_name", "protobuf::protoc")
+            self.cpp_info.components["protoc"].names["cmake_find_package"] = "protoc"
+            self.cpp_info.components["protoc"].names["cmake_find_package_multi"] = "protoc"
+            if self._builds_protoc and self.options.protoc_mode == "build":
+                self.cpp_info.components["protoc"].requires = ["libprotoc"]
 
         bindir = os.path.join(self.package_folder, "bin")
         self.output.info("Appending PATH environment variable: {}".format(bindir))
@@ -291,94 +1024,9 @@ if(DEFINED Protobuf_SRC_ROOT_FOLDER)""",
         #js_embed = "js_embed.exe" if self.settings.os_build == "Windows" else "js_embed"
         #self.env_info.JS_EMBED_BIN = os.path.normpath(os.path.join(self.package_folder, "bin", js_embed))
 
-        if self.settings.os == "Linux":
-            self.cpp_info.libs.append("pthread")
-            if self._is_clang_x86 or "arm" in str(self.settings.arch):
-                self.cpp_info.libs.append("atomic")
-
-        if self.settings.os == "Windows":
-            if self.options.shared:
-                self.cpp_info.defines = ["PROTOBUF_USE_DLLS"]
-
         self.cpp_info.names["cmake_find_package"] = "Protobuf"
         self.cpp_info.names["cmake_find_package_multi"] = "Protobuf"
 
-# TODO: use self.cpp_info.components + libprotobuf + libprotoc + protoc + libprotobuf-lite
-#
-#        self.cpp_info.names["cmake_find_package"] = "protobuf"
-#        self.cpp_info.names["cmake_find_package_multi"] = "protobuf"
-#
-#        lib_prefix = "lib" if (self._is_msvc or self._is_clang_cl or self.settings.compiler == "Visual Studio") else ""
-#        lib_suffix = "d" if self.settings.build_type == "Debug" else ""
-#
-#        self.cpp_info.components["libprotobuf"].names["cmake_find_package"] = "libprotobuf"
-#        self.cpp_info.components["libprotobuf"].names["cmake_find_package_multi"] = "libprotobuf"
-#        self.cpp_info.components["libprotobuf"].names["pkg_config"] = "protobuf"
-#        self.cpp_info.components["libprotobuf"].libs = [lib_prefix + "protobuf" + lib_suffix]
-#        if self.options.with_zlib:
-#            self.cpp_info.components["libprotobuf"].requires = ["zlib::zlib"]
-#        if self.settings.os == "Linux":
-#            self.cpp_info.components["libprotobuf"].system_libs.append("pthread")
-#            if self._is_clang_x86 or "arm" in str(self.settings.arch):
-#                self.cpp_info.components["libprotobuf"].system_libs.append("atomic")
-#        if self.settings.os == "Windows":
-#            if self.options.shared:
-#                self.cpp_info.components["libprotobuf"].defines = ["PROTOBUF_USE_DLLS"]
-#        if self.settings.os == "Android":
-#            self.cpp_info.components["libprotobuf"].system_libs.append("log")
-#
-#        self.cpp_info.components["libprotobuf"].builddirs = [
-#            self._cmake_install_base_path,
-#        ]
-#
-#        self.cpp_info.components["libprotobuf"].builddirs = [self._cmake_install_base_path]
-#        self.cpp_info.components["libprotobuf"].build_modules.extend([
-#            os.path.join(self._cmake_install_base_path, "protobuf-generate.cmake"),
-#            os.path.join(self._cmake_install_base_path, "protobuf-module.cmake"),
-#            os.path.join(self._cmake_install_base_path, "protobuf-options.cmake"),
-#        ])
-#
-#        self.cpp_info.components["libprotoc"].name = "libprotoc"
-#        self.cpp_info.components["libprotoc"].libs = [lib_prefix + "protoc" + lib_suffix]
-#        self.cpp_info.components["libprotoc"].requires = ["libprotobuf"]
-#
-#        self.cpp_info.components["protoc"].name = "protoc"
-#        self.cpp_info.components["protoc"].requires.extend(["libprotoc", "libprotobuf"])
-#
-#        bindir = os.path.join(self.package_folder, "bin")
-#        self.output.info("Appending PATH environment variable: {}".format(bindir))
-#        self.env_info.PATH.append(bindir)
-#
-#        if self.options.lite:
-#            self.cpp_info.components["libprotobuf-lite"].names["cmake_find_package"] = "libprotobuf-lite"
-#            self.cpp_info.components["libprotobuf-lite"].names["cmake_find_package_multi"] = "libprotobuf-lite"
-#            self.cpp_info.components["libprotobuf-lite"].names["pkg_config"] = "protobuf-lite"
-#            self.cpp_info.components["libprotobuf-lite"].libs = [lib_prefix + "protobuf-lite" + lib_suffix]
-#            if self.settings.os in ["Linux", "FreeBSD"]:
-#                self.cpp_info.components["libprotobuf-lite"].system_libs.append("pthread")
-#                if self._is_clang_x86 or "arm" in str(self.settings.arch):
-#                    self.cpp_info.components["libprotobuf-lite"].system_libs.append("atomic")
-#            if self.settings.os == "Windows":
-#                if self.options.shared:
-#                    self.cpp_info.components["libprotobuf-lite"].defines = ["PROTOBUF_USE_DLLS"]
-#            if self.settings.os == "Android":
-#                self.cpp_info.components["libprotobuf-lite"].system_libs.append("log")
-#
-#            self.cpp_info.components["libprotobuf-lite"].builddirs = [self._cmake_install_base_path]
-#            self.cpp_info.components["libprotobuf-lite"].build_modules.extend([
-#                os.path.join(self._cmake_install_base_path, "protobuf-generate.cmake"),
-#                os.path.join(self._cmake_install_base_path, "protobuf-module.cmake"),
-#                os.path.join(self._cmake_install_base_path, "protobuf-options.cmake"),
-#            ])
-#
-#        # TODO: to remove in conan v2 once cmake_find_package* & pkg_config generators removed
-#        self.cpp_info.filenames["cmake_find_package"] = "Protobuf"
-#        self.cpp_info.filenames["cmake_find_package_multi"] = "protobuf"
-#        self.cpp_info.names["pkg_config"] ="protobuf_full_package"
-#        self.cpp_info.components["libprotobuf"].build_modules = build_modules
-#        if self.options.lite:
-#            self.cpp_info.components["libprotobuf-lite"].build_modules = build_modules
-
     # see `conan install . -g deploy` in https://docs.conan.io/en/latest/devtools/running_packages.html
     #def deploy(self):
         # self.copy("*", dst="/usr/local/bin", src="bin", keep_path=False)
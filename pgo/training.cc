@@ -0,0 +1,124 @@
+// Training workload for profile-guided optimization of libprotobuf.
+//
+// Runs the hot paths of a typical service (serialize, ByteSize, parse, merge
+// and arena allocation) over the messages from training.proto so that the
+// instrumented library records a representative profile.
+//
+// Usage: protobuf_training [iterations]
+
+#include <cstdint>
+#include <cstdlib>
+#include <iostream>
+#include <string>
+
+#include <google/protobuf/arena.h>
+
+#include "training.pb.h"
+
+namespace {
+
+using protobuf_training::Envelope;
+using protobuf_training::Nested;
+using protobuf_training::Repeated;
+using protobuf_training::Small;
+using protobuf_training::Strings;
+
+void FillSmall(int seed, Small* small) {
+  small->set_id(seed);
+  small->set_timestamp(1600000000000LL + seed);
+  small->set_flag(seed % 2 == 0);
+  small->set_score(seed * 0.25);
+  small->set_status(seed % 3 == 0 ? protobuf_training::STATUS_FAILED
+                                  : protobuf_training::STATUS_OK);
+  small->set_delta(-seed);
+  small->set_hash(0x9E3779B97F4A7C15ULL * static_cast<uint64_t>(seed));
+}
+
+void FillNested(int seed, int depth, Nested* nested) {
+  nested->set_name("node-" + std::to_string(seed));
+  FillSmall(seed, nested->mutable_payload());
+  if (depth == 0) {
+    return;
+  }
+  for (int i = 0; i < 2; ++i) {
+    FillNested(seed * 2 + i, depth - 1, nested->add_children());
+  }
+}
+
+void FillRepeated(int seed, Repeated* repeated) {
+  for (int i = 0; i < 256; ++i) {
+    repeated->add_ints(seed + i);
+    repeated->add_longs((static_cast<int64_t>(seed) << 32) + i);
+    repeated->add_fixed(static_cast<uint32_t>(seed * i));
+    repeated->add_doubles(i * 1.5);
+  }
+  for (int i = 0; i < 32; ++i) {
+    FillSmall(seed + i, repeated->add_items());
+  }
+}
+
+void FillStrings(int seed, Strings* strings) {
+  strings->set_key("key-" + std::to_string(seed));
+  strings->set_blob(std::string(1024, static_cast<char>('a' + seed % 26)));
+  for (int i = 0; i < 16; ++i) {
+    strings->add_tags("tag-" + std::to_string(i));
+    (*strings->mutable_attributes())["attribute-" + std::to_string(i)] =
+        std::string(64, static_cast<char>('A' + i));
+  }
+}
+
+void FillEnvelope(int seed, Envelope* envelope) {
+  envelope->set_request_id(static_cast<uint64_t>(seed));
+  switch (seed % 4) {
+    case 0:
+      FillSmall(seed, envelope->mutable_small());
+      break;
+    case 1:
+      FillNested(seed, 6, envelope->mutable_nested());
+      break;
+    case 2:
+      FillRepeated(seed, envelope->mutable_repeated());
+      break;
+    default:
+      FillStrings(seed, envelope->mutable_strings());
+      break;
+  }
+}
+
+}  // namespace
+
+int main(int argc, char** argv) {
+  GOOGLE_PROTOBUF_VERIFY_VERSION;
+
+  const int iterations = argc > 1 ? std::atoi(argv[1]) : 20000;
+  uint64_t checksum = 0;
+  std::string wire;
+
+  for (int i = 0; i < iterations; ++i) {
+    Envelope envelope;
+    FillEnvelope(i, &envelope);
+    checksum += envelope.ByteSizeLong();
+    envelope.SerializeToString(&wire);
+
+    Envelope heap_parsed;
+    if (!heap_parsed.ParseFromString(wire)) {
+      std::cerr << "failed to parse message " << i << std::endl;
+      return 1;
+    }
+
+    google::protobuf::Arena arena;
+    Envelope* arena_parsed =
+        google::protobuf::Arena::CreateMessage<Envelope>(&arena);
+    if (!arena_parsed->ParseFromString(wire)) {
+      std::cerr << "failed to parse message " << i << " on arena" << std::endl;
+      return 1;
+    }
+    arena_parsed->MergeFrom(heap_parsed);
+    checksum += arena_parsed->ByteSizeLong();
+  }
+
+  std::cout << "protobuf_training: " << iterations
+            << " iterations, checksum " << checksum << std::endl;
+  google::protobuf::ShutdownProtobufLibrary();
+  return 0;
+}
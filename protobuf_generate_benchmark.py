@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""Compares the per-file and batched modes of protobuf_generate() (cmake/protobuf-generate.cmake).
+
+Generates a schema set of --files .proto files in packages of 50 files. Every file
+imports a shared common/types.proto, two files of its own package and, when protoc
+has them next to it, google/protobuf/timestamp.proto and descriptor.proto. Then, for
+the per-file mode and each of --batch-sizes, it configures a fresh build tree and
+times:
+
+    configure    cmake configure (including the import scan)
+    full         code generation of the whole schema set
+    noop         second build, nothing to do
+    incremental  build after adding a message to the first file of a package
+
+The content-hash cache (PROTOBUF_GENERATE_CACHE_DIR) is disabled for the runs.
+
+Example:
+    python protobuf_generate_benchmark.py --protoc ~/.conan/data/protobuf/.../bin/protoc \\
+        --batch-sizes 25,100,400 --output protobuf_generate_benchmark.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+RECIPE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+MODULE = os.path.join(RECIPE_FOLDER, "cmake", "protobuf-generate.cmake")
+PACKAGE_SIZE = 50
+
+CMAKELISTS = """\
+cmake_minimum_required(VERSION 3.12)
+project(protobuf_generate_benchmark NONE)
+
+include("{module}")
+set(Protobuf_PROTOC_EXECUTABLE "{protoc}")
+
+file(GLOB_RECURSE _protos "${{CMAKE_CURRENT_SOURCE_DIR}}/*.proto")
+protobuf_generate(OUT_VAR _generated PROTOS ${{_protos}} IMPORT_DIRS {import_dirs}
+  PROTOC_OUT_DIR "${{CMAKE_CURRENT_BINARY_DIR}}/generated")
+add_custom_target(codegen ALL DEPENDS ${{_generated}})
+"""
+
+
+def _find_well_known_types(protoc):
+    candidates = [os.path.join(os.path.dirname(os.path.realpath(protoc)), os.pardir, "include"),
+                  "/usr/local/include", "/usr/include"]
+    for candidate in candidates:
+        if os.path.isfile(os.path.join(candidate, "google", "protobuf", "descriptor.proto")):
+            return os.path.normpath(candidate)
+    return None
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _message(name, index, field_types):
+    fields = "\n".join("  {} field_{} = {};".format(field_types[(index + i) % len(field_types)], i, i + 1)
+                       for i in range(10))
+    return "message {} {{\n{}\n}}\n".format(name, fields)
+
+
+def _generate_schemas(schema_folder, count, well_known_types):
+    common = ['syntax = "proto3";', "package common;", ""]
+    common.append("enum Status {\n" + "\n".join("  STATUS_{} = {};".format(i, i) for i in range(20)) + "\n}\n")
+    for i in range(50):
+        common.append(_message("Type{}".format(i), i, ["int32", "int64", "string", "bytes", "double", "Status"]))
+    _write(os.path.join(schema_folder, "common", "types.proto"), "\n".join(common))
+
+    for index in range(count):
+        package, position = divmod(index, PACKAGE_SIZE)
+        imports = ['import "common/types.proto";']
+        field_types = ["int32", "string", "common.Type{}".format(index % 50), "common.Status"]
+        if well_known_types:
+            imports.append('import "google/protobuf/timestamp.proto";')
+            imports.append('import "google/protobuf/descriptor.proto";')
+            field_types.extend(["google.protobuf.Timestamp", "google.protobuf.FieldDescriptorProto"])
+        for previous in (position - 1, position // 2):
+            if 0 <= previous < position:
+                imports.append('import "pkg{:03d}/file{:04d}.proto";'.format(package, package * PACKAGE_SIZE + previous))
+                field_types.append("pkg{:03d}.File{:04d}Message0".format(package, package * PACKAGE_SIZE + previous))
+        content = ['syntax = "proto3";', "package pkg{:03d};".format(package), ""] + sorted(set(imports)) + [""]
+        for message in range(5):
+            content.append(_message("File{:04d}Message{}".format(index, message), message, field_types))
+        _write(os.path.join(schema_folder, "pkg{:03d}".format(package), "file{:04d}.proto".format(index)),
+               "\n".join(content))
+
+
+def _timed(command, env):
+    start = time.perf_counter()
+    subprocess.check_call(command, env=env, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def _run_mode(args, schema_folder, name, batch_size, env):
+    build_folder = os.path.join(args.work_folder, "build-" + name)
+    shutil.rmtree(build_folder, ignore_errors=True)
+    configure = ["cmake", "-S", schema_folder, "-B", build_folder, "-DPROTOBUF_GENERATE_BATCH_SIZE={}".format(batch_size)]
+    if args.generator:
+        configure.extend(["-G", args.generator])
+    build = ["cmake", "--build", build_folder, "--parallel", str(args.jobs)]
+
+    result = {"mode": name, "batch_size": batch_size}
+    result["configure_s"] = _timed(configure, env)
+    result["full_s"] = _timed(build, env)
+    result["noop_s"] = _timed(build, env)
+    edited = os.path.join(schema_folder, "pkg000", "file0000.proto")
+    with open(edited) as f:
+        original = f.read()
+    try:
+        with open(edited, "a") as f:
+            f.write("\nmessage Added {\n  int32 value = 1;\n}\n")
+        result["incremental_s"] = _timed(build, env)
+    finally:
+        with open(edited, "w") as f:
+            f.write(original)
+    print("protobuf_generate_benchmark: {mode}: configure {configure_s:.2f}s, full {full_s:.2f}s, "
+          "noop {noop_s:.2f}s, incremental {incremental_s:.2f}s".format(**result), flush=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--protoc", default=os.environ.get("PROTOC_BIN") or shutil.which("protoc"),
+                        help="protoc to benchmark (default: PROTOC_BIN or protoc in PATH)")
+    parser.add_argument("--files", type=int, default=2000, help="number of generated .proto files")
+    parser.add_argument("--batch-sizes", default="50,200", help="comma separated BATCH_SIZE values to compare")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(), help="parallel build jobs")
+    parser.add_argument("--generator", default="Ninja" if shutil.which("ninja") else None, help="CMake generator")
+    parser.add_argument("--work-folder", default=os.path.join(RECIPE_FOLDER, "protobuf_generate_benchmark"),
+                        help="folder for the schema set and the build trees")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+    if not args.protoc:
+        parser.error("protoc not found, pass --protoc")
+    args.protoc = os.path.abspath(args.protoc)
+    args.work_folder = os.path.abspath(args.work_folder)
+
+    schema_folder = os.path.join(args.work_folder, "schemas")
+    shutil.rmtree(schema_folder, ignore_errors=True)
+    well_known_types = _find_well_known_types(args.protoc)
+    _generate_schemas(schema_folder, args.files, well_known_types)
+    import_dirs = '"${CMAKE_CURRENT_SOURCE_DIR}"' + (' "{}"'.format(well_known_types) if well_known_types else "")
+    _write(os.path.join(schema_folder, "CMakeLists.txt"),
+           CMAKELISTS.format(module=MODULE.replace("\\", "/"), protoc=args.protoc.replace("\\", "/"),
+                             import_dirs=import_dirs.replace("\\", "/")))
+
+    env = dict(os.environ)
+    env.pop("PROTOBUF_GENERATE_CACHE_DIR", None)
+    modes = [("per_file", 0)] + [("batch_{}".format(size), int(size)) for size in args.batch_sizes.split(",")]
+    results = {
+        "protoc": args.protoc,
+        "protoc_version": subprocess.check_output([args.protoc, "--version"]).decode().strip(),
+        "files": args.files,
+        "well_known_types": bool(well_known_types),
+        "jobs": args.jobs,
+        "generator": args.generator,
+        "modes": [_run_mode(args, schema_folder, name, batch_size, env) for name, batch_size in modes],
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
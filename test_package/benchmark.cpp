@@ -0,0 +1,277 @@
+// Parse/serialize benchmark of the packaged protobuf runtime.
+//
+// For every schema in proto/ it measures serialize, ByteSize and parse
+// throughput, parsing both into heap allocated messages and into messages
+// allocated on a google::protobuf::Arena, and writes the results as JSON.
+// Built with PROTOBUF_BENCHMARK_GZIP (packages with zlib) it also measures
+// serialize through CodedOutputStream and parse from GzipOutputStream /
+// GzipInputStream compressed streams.
+//
+// Usage: protobuf_benchmark [--output FILE] [--min-time SECONDS]
+//                           [--meta KEY=VALUE]...
+
+#include <chrono>
+#include <cstdint>
+#include <cstdlib>
+#include <fstream>
+#include <iostream>
+#include <map>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#include <google/protobuf/arena.h>
+#include <google/protobuf/stubs/common.h>
+#ifdef PROTOBUF_BENCHMARK_GZIP
+#include <google/protobuf/io/coded_stream.h>
+#include <google/protobuf/io/gzip_stream.h>
+#include <google/protobuf/io/zero_copy_stream_impl_lite.h>
+#endif
+
+#include "nested.pb.h"
+#include "repeated.pb.h"
+#include "small.pb.h"
+#include "strings.pb.h"
+
+namespace {
+
+using Clock = std::chrono::steady_clock;
+
+struct Result {
+  std::string schema;
+  std::string operation;
+  uint64_t iterations;
+  double seconds;
+  size_t message_bytes;
+};
+
+// Keeps the optimizer from discarding the measured work.
+volatile uint64_t g_sink = 0;
+
+// Runs `op` in growing batches until at least `min_time` seconds elapsed.
+template <typename Op>
+Result Measure(const std::string& schema, const std::string& operation,
+               size_t message_bytes, double min_time, Op op) {
+  // Warm up caches and allocator pools.
+  for (int i = 0; i < 16; ++i) {
+    op();
+  }
+  uint64_t iterations = 0;
+  uint64_t batch = 1;
+  double seconds = 0;
+  const Clock::time_point start = Clock::now();
+  while (seconds < min_time) {
+    for (uint64_t i = 0; i < batch; ++i) {
+      op();
+    }
+    iterations += batch;
+    batch *= 2;
+    seconds = std::chrono::duration<double>(Clock::now() - start).count();
+  }
+  return Result{schema, operation, iterations, seconds, message_bytes};
+}
+
+template <typename Message>
+void RunSchema(const std::string& schema, const Message& sample,
+               double min_time, std::vector<Result>* results) {
+  std::string wire;
+  sample.SerializeToString(&wire);
+  const size_t bytes = wire.size();
+
+  std::string buffer;
+  results->push_back(Measure(schema, "serialize", bytes, min_time, [&] {
+    sample.SerializeToString(&buffer);
+    g_sink += buffer.size();
+  }));
+  results->push_back(Measure(schema, "byte_size", bytes, min_time, [&] {
+    g_sink += sample.ByteSizeLong();
+  }));
+  results->push_back(Measure(schema, "parse_heap", bytes, min_time, [&] {
+    Message* message = new Message;
+    if (!message->ParseFromString(wire)) {
+      std::abort();
+    }
+    g_sink += message->ByteSizeLong();
+    delete message;
+  }));
+
+  google::protobuf::Arena arena;
+  results->push_back(Measure(schema, "parse_arena", bytes, min_time, [&] {
+    Message* message = google::protobuf::Arena::CreateMessage<Message>(&arena);
+    if (!message->ParseFromString(wire)) {
+      std::abort();
+    }
+    g_sink += message->ByteSizeLong();
+    arena.Reset();
+  }));
+
+#ifdef PROTOBUF_BENCHMARK_GZIP
+  // Throughput is of the uncompressed message bytes, like the other operations.
+  results->push_back(Measure(schema, "gzip_serialize", bytes, min_time, [&] {
+    buffer.clear();
+    google::protobuf::io::StringOutputStream string_stream(&buffer);
+    google::protobuf::io::GzipOutputStream gzip_stream(&string_stream);
+    {
+      google::protobuf::io::CodedOutputStream coded_stream(&gzip_stream);
+      sample.SerializeToCodedStream(&coded_stream);
+    }
+    if (!gzip_stream.Close()) {
+      std::abort();
+    }
+    g_sink += buffer.size();
+  }));
+  const std::string compressed = buffer;
+  results->push_back(Measure(schema, "gzip_parse", bytes, min_time, [&] {
+    google::protobuf::io::ArrayInputStream array_stream(
+        compressed.data(), static_cast<int>(compressed.size()));
+    google::protobuf::io::GzipInputStream gzip_stream(&array_stream);
+    Message message;
+    if (!message.ParseFromZeroCopyStream(&gzip_stream)) {
+      std::abort();
+    }
+    g_sink += message.ByteSizeLong();
+  }));
+#endif
+}
+
+protobuf_benchmark::Small MakeSmall(int seed) {
+  protobuf_benchmark::Small small;
+  small.set_id(seed);
+  small.set_timestamp(1600000000000LL + seed);
+  small.set_flag(seed % 2 == 0);
+  small.set_score(seed * 0.25);
+  small.set_delta(-seed);
+  small.set_hash(0x9E3779B97F4A7C15ULL * static_cast<uint64_t>(seed + 1));
+  small.set_flags(0xF0F0u);
+  small.set_ratio(0.5f);
+  return small;
+}
+
+void FillNode(int id, int depth, protobuf_benchmark::Node* node) {
+  node->set_id(id);
+  node->set_label("node-" + std::to_string(id));
+  if (depth == 0) {
+    return;
+  }
+  FillNode(id * 2, depth - 1, node->mutable_left());
+  FillNode(id * 2 + 1, depth - 1, node->mutable_right());
+}
+
+protobuf_benchmark::Nested MakeNested() {
+  protobuf_benchmark::Nested nested;
+  nested.set_version(1);
+  FillNode(1, 10, nested.mutable_root());
+  return nested;
+}
+
+protobuf_benchmark::Repeated MakeRepeated() {
+  protobuf_benchmark::Repeated repeated;
+  for (int i = 0; i < 4096; ++i) {
+    repeated.add_ints(i * 7 - 1000);
+    repeated.add_longs((static_cast<int64_t>(i) << 33) + i);
+    repeated.add_fixed(static_cast<uint32_t>(i * 2654435761u));
+    repeated.add_doubles(i * 1.5);
+    repeated.add_flags(i % 3 == 0);
+  }
+  for (int i = 0; i < 512; ++i) {
+    protobuf_benchmark::Point* point = repeated.add_points();
+    point->set_x(-i);
+    point->set_y(i * 1000);
+    point->set_weight(static_cast<uint32_t>(i));
+  }
+  return repeated;
+}
+
+protobuf_benchmark::Strings MakeStrings() {
+  protobuf_benchmark::Strings strings;
+  strings.set_key("benchmark-key");
+  strings.set_blob(std::string(16 * 1024, 'x'));
+  for (int i = 0; i < 128; ++i) {
+    strings.add_tags("tag-" + std::to_string(i));
+    (*strings.mutable_attributes())["attribute-" + std::to_string(i)] =
+        std::string(96, static_cast<char>('a' + i % 26));
+  }
+  for (int i = 0; i < 16; ++i) {
+    strings.add_chunks(std::string(1024, static_cast<char>(i)));
+  }
+  return strings;
+}
+
+std::string JsonEscape(const std::string& value) {
+  std::string escaped;
+  for (char c : value) {
+    if (c == '"' || c == '\\') {
+      escaped += '\\';
+    }
+    escaped += c;
+  }
+  return escaped;
+}
+
+std::string ToJson(const std::map<std::string, std::string>& metadata,
+                   const std::vector<Result>& results) {
+  std::ostringstream json;
+  json << "{\n  \"protobuf_runtime_version\": " << GOOGLE_PROTOBUF_VERSION
+       << ",\n  \"metadata\": {";
+  const char* separator = "";
+  for (const auto& entry : metadata) {
+    json << separator << "\n    \"" << JsonEscape(entry.first) << "\": \""
+         << JsonEscape(entry.second) << "\"";
+    separator = ",";
+  }
+  json << "\n  },\n  \"results\": [";
+  separator = "";
+  for (const Result& result : results) {
+    const double ns_per_op = result.seconds * 1e9 / result.iterations;
+    const double mb_per_s = result.message_bytes * result.iterations /
+                            result.seconds / (1024.0 * 1024.0);
+    json << separator << "\n    {\"schema\": \"" << result.schema
+         << "\", \"operation\": \"" << result.operation
+         << "\", \"message_bytes\": " << result.message_bytes
+         << ", \"iterations\": " << result.iterations
+         << ", \"ns_per_op\": " << ns_per_op
+         << ", \"mb_per_s\": " << mb_per_s << "}";
+    separator = ",";
+  }
+  json << "\n  ]\n}\n";
+  return json.str();
+}
+
+}  // namespace
+
+int main(int argc, char** argv) {
+  GOOGLE_PROTOBUF_VERIFY_VERSION;
+
+  std::string output = "benchmark.json";
+  double min_time = 0.2;
+  std::map<std::string, std::string> metadata;
+  for (int i = 1; i + 1 < argc; i += 2) {
+    const std::string flag = argv[i];
+    const std::string value = argv[i + 1];
+    if (flag == "--output") {
+      output = value;
+    } else if (flag == "--min-time") {
+      min_time = std::atof(value.c_str());
+    } else if (flag == "--meta") {
+      const size_t equals = value.find('=');
+      metadata[value.substr(0, equals)] =
+          equals == std::string::npos ? "" : value.substr(equals + 1);
+    } else {
+      std::cerr << "unknown argument: " << flag << std::endl;
+      return 1;
+    }
+  }
+
+  std::vector<Result> results;
+  RunSchema("small", MakeSmall(42), min_time, &results);
+  RunSchema("nested", MakeNested(), min_time, &results);
+  RunSchema("repeated", MakeRepeated(), min_time, &results);
+  RunSchema("strings", MakeStrings(), min_time, &results);
+
+  const std::string json = ToJson(metadata, results);
+  std::ofstream(output) << json;
+  std::cout << json;
+
+  google::protobuf::ShutdownProtobufLibrary();
+  return 0;
+}
@@ -0,0 +1,73 @@
+import os
+from conans import ConanFile, CMake, tools
+
+
+# Parse/serialize benchmark of the packaged protoc and libprotobuf, for each codegen profile (speed, size, lite).
+# Results are written as JSON to PROTOBUF_BENCHMARK_OUTPUT (default: benchmark.json in the build folder),
+# one file per profile (benchmark-speed.json, ...), so they can be diffed between package revisions.
+class ProtobufBenchmarkConan(ConanFile):
+    settings = "os", "compiler", "build_type", "arch"
+    generators = "cmake"
+
+    @property
+    def _protoc(self):
+        return self.deps_user_info["protobuf"].PROTOC_BIN
+
+    @property
+    def _protoc_only(self):
+        options = self.options["protobuf"]
+        return "protoc_mode" in options and options.protoc_mode == "tool"
+
+    @property
+    def _protoc_runs_here(self):
+        # Cross builds package a protoc of the target machine, unless it comes from the build context (external)
+        options = self.options["protobuf"]
+        return not tools.cross_building(self) or ("protoc_mode" in options and options.protoc_mode == "external")
+
+    @property
+    def _benchmark_metadata(self):
+        options = self.options["protobuf"]
+        metadata = {
+            "protobuf": self.deps_cpp_info["protobuf"].version,
+            "os": self.settings.os,
+            "arch": self.settings.arch,
+            "compiler": "{} {}".format(self.settings.compiler, self.settings.compiler.version),
+            "build_type": self.settings.build_type,
+        }
+        for option in ["shared", "lite", "with_zlib", "zlib_backend", "with_rtti", "lto", "pgo", "allocator",
+                       "arenas_by_default", "codegen_profile"]:
+            if option in options:
+                metadata[option] = getattr(options, option)
+        return metadata
+
+    def build(self):
+        if not os.path.isfile(self._protoc):
+            self.output.warn("protoc was not packaged (lite), skipping the benchmark")
+            return
+        if self._protoc_only:
+            self.output.warn("only protoc was packaged (protoc_mode=tool), skipping the benchmark")
+            return
+        if not self._protoc_runs_here:
+            self.output.warn("protoc was built for the target machine (cross-building), skipping the benchmark")
+            return
+        cmake = CMake(self)
+        # gzip_serialize/gzip_parse, compressed stream throughput of the zlib backend
+        cmake.definitions["PROTOBUF_BENCHMARK_GZIP"] = self.options["protobuf"].with_zlib
+        cmake.configure()
+        cmake.build()
+
+    def test(self):
+        if tools.cross_building(self) or not os.path.isfile(self._protoc):
+            return
+        if self._protoc_only:
+            return
+        output = tools.get_env("PROTOBUF_BENCHMARK_OUTPUT", os.path.join(self.build_folder, "benchmark.json"))
+        output_root, output_extension = os.path.splitext(output)
+        for profile in ["speed", "size", "lite"]:
+            benchmark = os.path.join("bin", "protobuf_benchmark_{}".format(profile))
+            metadata = dict(self._benchmark_metadata, generated_code=profile,
+                            binary_bytes=os.path.getsize(benchmark + (".exe" if self.settings.os == "Windows" else "")))
+            metadata = " ".join('--meta "{}={}"'.format(key, value) for key, value in sorted(metadata.items()))
+            profile_output = "{}-{}{}".format(output_root, profile, output_extension)
+            self.run('{} --output "{}" {}'.format(benchmark, profile_output, metadata), run_environment=True)
+            self.output.info("Benchmark results: %s" % (profile_output))